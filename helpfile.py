@@ -38,6 +38,13 @@ The command supports the following options:
                         wether to read the FLAG+FLAG_ROW columns; see the 'show' command.
                         Default: True
 
+    cache=t(rue)|f(alse)
+                        the meta data of an MS is cached on disk (in
+                        $HOME/.jplotter.cache/meta) such that re-opening an
+                        unmodified MS does not require scanning it again.
+                        With cache=f the MS is always scanned.
+                        Default: True
+
 Example:
 
     > ms X3c1.ms unique=f spw_order=by_id column=alma_phase_corr
@@ -63,6 +70,10 @@ Inspect the list of scans using 'r scan' (see the 'r' command ('r'='range')) or
 the 'listr' command. It was decided to not include the scan list in the default
 'r' output because it can be quite a long list.
 
+The scan list is cached on disk (in $HOME/.jplotter.cache/meta). When an MS
+for which 'indexr' was run before is opened again, the scan list is loaded
+from there and can be used straight away, unless the MS was modified since.
+
 A scan, as defined by this software, is a time-continuous range where the same
 (sub)array of telescopes (ARRAY_ID) is observing the same source (FIELD_ID).
 
@@ -282,6 +293,121 @@ False for quick opening of MSs.
 
 Changing the setting will not take effect until a new MS is opened.
 
+""",
+
+    ##################################################################
+    # nproc
+    ##################################################################
+    "nproc":
+"""nproc [<number>]
+    display/set the number of processes used for reading data
+
+By default the data is read from the MS and reduced into data sets by one
+process, in chunks of rows, one after the other.
+
+On multi-core machines setting 'nproc' to a value larger than one will split
+the (selected) rows of the MS into disjoint ranges of rows. Each of the 'nproc'
+worker processes opens the MS, re-executes the selection and reduces the
+ranges it was given. The partial data sets are merged back, in order, into the
+final data sets. The resulting plots are identical to the ones produced by
+a single process.
+
+Note that each worker process needs memory for its own chunks of data.
+
+    > nproc 8
+
+""",
+
+    ##################################################################
+    # prefetch
+    ##################################################################
+    "prefetch":
+"""prefetch [<number>]
+    display/set the number of chunks of data to read ahead
+
+The data is read from the MS in chunks of rows. While a chunk is being
+processed, a background reader can already read the next chunk(s) from disk,
+such that reading and processing overlap in time. This is especially
+beneficial for MSs on network mounted disks.
+
+The number sets how many chunks the reader may be ahead of the processing
+(default: 1). Each chunk read ahead costs the memory of one chunk of data.
+Setting it to 0 disables reading ahead.
+
+    > prefetch 2
+
+""",
+
+    ##################################################################
+    # mem
+    ##################################################################
+    "mem":
+"""mem [<amount>[k|M|G]]
+    display/set the amount of memory to use for reading data
+
+The data is read from the MS in chunks of rows. The number of rows per chunk
+is computed such that the column data of all chunks that are in memory at the
+same time fit in the amount of memory set by this command (default: 512MB).
+
+The size of a row is determined after channel selection, so a selection of
+a few channels out of many allows for (much) larger chunks. Chunks read ahead
+(see "prefetch") and chunks being processed by worker processes (see "nproc")
+are taken into account.
+
+Note that processing the data temporarily needs more memory than only the
+raw column data.
+
+    > mem 2G
+    > mem 300M
+
+""",
+
+    ##################################################################
+    # index
+    ##################################################################
+    "index":
+"""index [build|drop]
+    display/build/remove the meta data index of the current MS
+
+Selecting the data to plot means evaluating the selection on the meta data
+columns of the MS (antennas, time, data description id, source). For large
+data sets it is faster to do this from an index: a copy of those columns
+stored as numpy arrays (in $HOME/.jplotter.cache/index). The index must be
+built once per MS and is used automatically when the MS is opened.
+
+If the MS is modified after the index was built, the index is stale and will
+not be used; just build it again.
+
+    build       (re)build the index for the current MS
+    drop        remove the index of the current MS
+
+    > index build
+""",
+
+    ##################################################################
+    # cache
+    ##################################################################
+    "cache":
+"""cache [on|off|clear|<size>[k|M|G]]
+    display/change the on-disk cache of data sets
+
+After the data has been read from the MS and reduced into data sets, the data
+sets are stored in a cache on disk (in $HOME/.jplotter.cache/plots). When
+plotting is requested of the same MS with the same selection, averaging,
+solint, weight threshold and plot type, the data sets are loaded from the
+cache in stead of read from the MS again - also in a later session.
+
+The cache is invalidated automatically when the MS is modified. When the cache
+grows beyond its maximum size (default: 2GB) the least recently used entries
+are removed.
+
+    on, off     enable/disable using the cache
+    clear       remove all entries from the cache
+    <size>      set the maximum size of the cache
+
+    > cache 500M
+    > cache off
+
 """,
 
     ##################################################################
@@ -1220,6 +1346,10 @@ point being tested. The expression is interpreted as Python code - so
 arithmetic and boolean operations like 'and' and/or 'or' are perfectly legal,
 if you stick to Python syntax ...
 
+Where possible the expression is evaluated for all points of a data set at
+once, using numpy. Expressions that cannot be evaluated that way are
+evaluated point by point, which is a lot slower.
+
 The special expression "none" will remove the marking condition for the
 indicated y-axis/axes.
 
@@ -1373,11 +1503,51 @@ Thus:
         the difference between all the y-ordinate arrays in each data set.
         Should the number of y-ordinates be different, then only the first 'n'
         values will be differenced and returned, with 'n' being the shorter
-        length of the two.
+        length of the two. To compare data from different measurement sets or
+        different time averaging settings the points can be matched by
+        x-abcissa in stead, see "help align".
 
 (*) Of course, no software could be complete without a mild laugh about Perl
 (;-)) where the '_' variable is the 'default' variable, whatever that means ...
 
+""",
+
+    ##################################################################
+    # align
+    ##################################################################
+"align":
+"""align [none|x|interpolate [<tolerance>|auto]]
+    display/set how data sets are aligned when combined in expressions
+
+When two collections of plots are combined in a "store" or "load" expression
+(e.g. "store foo - bar as diff") the y-ordinates of data sets with the same
+label are combined. This setting determines which points of the data sets are
+combined with each other:
+
+    none          (default) points are combined by index. Should the number of
+                  y-ordinates be different, then only the first 'n' values will
+                  be combined, with 'n' being the shorter length of the two
+    x             each point of the left-hand data set is combined with the
+                  point of the right-hand data set with the nearest
+                  x-abcissa, if that is within <tolerance>
+    interpolate   the right-hand data set is linearly interpolated at the
+                  x-abcissae of the left-hand data set, only between points
+                  that are at most <tolerance> apart
+
+The tolerance is in units of the x-axis (seconds for time, channel number for
+channel). With 'auto' (the default) it is set per data set from the smallest
+x-step of the right-hand data set: half of it for 'x' and one and a half times
+it for 'interpolate', i.e. no interpolation across missing points. A
+right-hand data set of only one point then only matches exactly.
+
+Points of the left-hand data set that have no counterpart are dropped. The
+result is flagged where either of the participating points is flagged.
+
+Note that interpolation of phases does not take phase wraps into account.
+
+    > align x 5
+    > store ms1_data - ms2_data as diff
+
 """,
 
     ##################################################################
@@ -1718,7 +1888,7 @@ Examples:
     # animate
     ##################################################################
 "animate":
-"""animate [<selection>] by <attribute> [, <attribute> ...]
+"""animate [<selection>] by <attribute> [, <attribute> ...] [fps=<rate>]
     animate current set of plots by e.g. 'time' for a movie
 
 Groups all the (selected) plots by distinct <attribute> value and cycles through
@@ -1767,6 +1937,18 @@ The full syntax of the command is:
 For the 'time' attribute the full time selection syntax can be used:
     > animate unb_amptime: time > $end - 1h10s by sb
 
+The frames are displayed at <rate> frames per second (default: 0.7):
+
+    > animate by time fps=10
+
+Each frame is drawn only once; during the first cycle the drawing commands
+are recorded and subsequent cycles replay those. The recorded frames are
+kept in memory up to the amount set by "mem"; frames that do not fit are
+redrawn every cycle.
+
+The frames are prepared for display when they are shown for the first time,
+so the animation starts as soon as the first frame is ready.
+
 """,
 
 
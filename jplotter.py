@@ -395,6 +395,7 @@
 #
 import copy, re, math, operator, itertools, plotiterator, ppgplot, datetime, os, subprocess, numpy, parsers, imp, time
 import jenums, selection, ms2mappings, plots, ms2util, hvutil, pyrap.quanta, sys, pydoc, collections, gencolors
+import plotcache, msindex
 from   functional import compose
 
 CP   = copy.deepcopy
@@ -420,6 +421,9 @@ class jplotter:
         # table of a MS ('unique==True')
         self.unique = d['unique']
 
+        # the on-disk cache of reduced data sets survives a reset()
+        self.plotCache = plotcache.plotcache()
+
         # Our data members
         self.reset()
 
@@ -435,18 +439,26 @@ class jplotter:
                 if mo:
                     return bool( mo.group('yes') )
                 raise RuntimeError, "{0} is not a valid boolean expression".format(x)
-            (arguments, options) = hvutil.split_optarg(*args, **{'unique':as_bool, 'readflags':as_bool})
+            (arguments, options) = hvutil.split_optarg(*args, **{'unique':as_bool, 'readflags':as_bool, 'cache':as_bool})
             if len(arguments)>1:
                 raise RuntimeError, "ms() takes only one or no parameters"
             # attempt to open the measurement set
             try:
                 # Update our defaults with what the user specified on the command line
-                self.mappings.load(arguments[0], **dict({'unique': self.unique}, **options))
+                self.mappings.load(arguments[0], **dict({'unique': self.unique, 'nproc': self.nproc}, **options))
                 self.msname    = arguments[0]
                 self.scanlist  = []
                 self.dirty     = True
                 self.selection = selection.selection()
                 self.readFlags = options.get('readflags', True)
+                self.msIndex   = msindex.msindex(self.msname).open(self.mappings.numRows)
+                # the complex data read from the previous MS is of no use anymore
+                plotiterator.rawCacheClear()
+                # if indexr was run before on this MS, we have the scans already
+                scans          = self.cachedScans()
+                if scans is not None:
+                    self.scanlist      = self.unmapScans(scans)
+                    self.indexr_lastms = CP(self.msname)
             except Exception as E:
                 print E
         if self.msname:
@@ -469,6 +481,99 @@ class jplotter:
                 self.unique = bool(int(args[0]))
         print "unique meta data: ",self.unique
 
+    def numProc(self, *args):
+        if args:
+            if len(args)>1:
+                raise RuntimeError, "This command supports only one argument"
+            n = int(args[0])
+            if n<1:
+                raise RuntimeError, "The number of processes must be >= 1"
+            self.nproc = n
+        print "nproc: ",self.nproc
+
+    def cacheSettings(self, *args):
+        if args:
+            if len(args)>1:
+                raise RuntimeError, "This command supports only one argument"
+            arg = args[0].lower()
+            if arg in ["on", "t", "true", "1"]:
+                self.plotCache.enabled = True
+            elif arg in ["off", "f", "false", "0"]:
+                self.plotCache.enabled = False
+            elif arg=="clear":
+                self.plotCache.clear()
+                plotiterator.rawCacheClear()
+            else:
+                mo = re.match(r"^(?P<n>[0-9]+(\.[0-9]*)?)(?P<unit>[kMG])B?$", args[0])
+                if not mo:
+                    raise RuntimeError, "'{0}' is not a valid cache command/size".format(args[0])
+                self.plotCache.maxsize = int(float(mo.group('n')) * {'k':1024, 'M':1024**2, 'G':1024**3}[mo.group('unit')])
+                self.plotCache.evict()
+        print self.plotCache
+
+    def indexSettings(self, *args):
+        pfx  = "index:"
+        errf = hvutil.mkerrf("{0} ".format(pfx, self.msname))
+        if not self.msname:
+            return errf("No MS loaded yet")
+        idx = msindex.msindex(self.msname)
+        if args:
+            if len(args)>1:
+                raise RuntimeError, "This command supports only one argument"
+            if args[0]=="build":
+                print "Building index. This may take some time."
+                s = NOW()
+                self.msIndex = idx.build()
+                print "Building index took\t{0:.3f}s".format( NOW()-s )
+            elif args[0]=="drop":
+                idx.drop()
+                self.msIndex = None
+            else:
+                raise RuntimeError, "'{0}' is not a valid index command".format(args[0])
+        print idx
+
+    def prefetchDepth(self, *args):
+        if args:
+            if len(args)>1:
+                raise RuntimeError, "This command supports only one argument"
+            n = int(args[0])
+            if n<0:
+                raise RuntimeError, "The prefetch depth must be >= 0"
+            self.prefetch = n
+        print "prefetch: ",self.prefetch
+
+    def memoryCap(self, *args):
+        if args:
+            if len(args)>1:
+                raise RuntimeError, "This command supports only one argument"
+            mo = re.match(r"^(?P<n>[0-9]+(\.[0-9]*)?)(?P<unit>[kMG])?B?$", args[0])
+            if not mo:
+                raise RuntimeError, "'{0}' is not a valid amount of memory".format(args[0])
+            n = float(mo.group('n')) * {None:1, 'k':1024, 'M':1024**2, 'G':1024**3}[mo.group('unit')]
+            if n<1024**2:
+                raise RuntimeError, "The memory cap must be at least 1MB"
+            self.memory = int(n)
+        print "mem: {0:.1f}MB".format( self.memory/1024.0**2 )
+
+    def alignment(self, *args):
+        if args:
+            if len(args)>2:
+                raise RuntimeError, "This command supports at most two arguments"
+            how = args[0].lower()
+            if how not in parsers.alignMethods:
+                raise RuntimeError, "'{0}' is not a valid alignment, use one of {1}".format(args[0], parsers.alignMethods)
+            tol = None
+            if len(args)>1 and args[1].lower()!="auto":
+                try:
+                    tol = float(args[1])
+                except:
+                    raise RuntimeError, "'{0}' is not a valid tolerance (float)".format(args[1])
+                if tol<0:
+                    raise RuntimeError, "The tolerance must be >= 0"
+            self.align = (how, tol)
+        (how, tol) = self.align
+        print "align: {0}{1}".format(how, "" if how=="none" else " tolerance={0}".format("auto" if tol is None else tol))
+
     def haveMS(self):
         return self.msname
 
@@ -571,20 +676,38 @@ class jplotter:
             setattr(self, lmsvar, None)
 
         if not self.scanlist or self.indexr_lastms!=self.msname:
-            # need to recompute scan list.
-            # From indexr() we only get field_ids in the scan object
-            # so we immediately transform them into field names
-            print "Running indexr. This may take some time."
-            unmapFLD = self.mappings.fieldMap.field
-            def unmapFLDfn(x):
-                x.field = unmapFLD(x.field_id)
-                return x
-            self.scanlist = map(unmapFLDfn, ms2util.indexr(self.msname))
+            # need to recompute scan list, unless we did that before
+            # for this MS and it was not modified since
+            scans = self.cachedScans()
+            if scans is None:
+                print "Running indexr. This may take some time."
+                scans = ms2util.indexr(self.msname, nproc=self.nproc)
+                try:
+                    ms2mappings.cachePut(self.msname, "scans", self.scanCacheKey(), scans)
+                except Exception as E:
+                    print "Failed to cache scan list - {0}".format(E)
+            self.scanlist = self.unmapScans(scans)
             # and store the current ms
             self.indexr_lastms = CP(self.msname)
         print "indexr: found ",len(self.scanlist)," scans. (use 'listr' to inspect)"
         return self.scanlist
 
+    def scanCacheKey(self):
+        return (os.path.abspath(self.msname), ms2util.tableModificationTime(self.msname), self.mappings.numRows)
+
+    # the scan list as computed before for the current MS, or None
+    def cachedScans(self):
+        return ms2mappings.cacheGet(self.msname, "scans", self.scanCacheKey())
+
+    # From indexr() we only get field_ids in the scan object
+    # so we immediately transform them into field names
+    def unmapScans(self, scans):
+        unmapFLD = self.mappings.fieldMap.field
+        def unmapFLDfn(x):
+            x.field = unmapFLD(x.field_id)
+            return x
+        return map(unmapFLDfn, scans)
+
     ## display or select time-range + source via scan
     def scans(self, *args):
         pfx = "scan:"
@@ -1464,12 +1587,38 @@ class jplotter:
         if sel_.averageTime!=AVG.None and sel_.averageChannel!=AVG.None:
             raise RuntimeError, "Unfortunately, we cannot do time *and* channel averaging at the same time at the moment. Please disable one (or both)"
 
-        ## Create the plots!
-        with plotiterator.Iterators[self.selection.plotType] as p:
-            s = NOW()
-            pl = p.makePlots(self.msname, self.selection, self.mappings, readflags=self.readFlags)
-            e = NOW()
-        print "Data munching took\t{0:.3f}s".format( e-s )
+        ## The reduced data only depends on the contents of the MS and
+        ## these settings. If we've seen them before, we can skip reading the MS.
+        ## Walking the table's files is not free so do that only once
+        mtime = ms2util.tableModificationTime(self.msname)
+        key = self.plotCache.key(os.path.abspath(self.msname), mtime,
+                                 sel_.plotType, sel_.selectionTaQL(), sel_.chanSel, sel_.ddSelection,
+                                 str(sel_.averageTime), str(sel_.averageChannel), sel_.solint, sel_.timeRange,
+                                 sel_.weightThreshold, self.readFlags, map_.domain.column, str(map_.spectralMap))
+        s  = NOW()
+        ## If the selection is a narrowed version of the one we read the data
+        ## with most recently, we can just filter the data sets we already have
+        pl = self.narrowedPlots(mtime)
+        if pl is not None:
+            print "Narrowing selection took\t{0:.3f}s".format( NOW()-s )
+        else:
+            pl = self.plotCache.get(key)
+            if pl is not None:
+                print "Cached data loading took\t{0:.3f}s".format( NOW()-s )
+            else:
+                ## Create the plots!
+                index = self.msIndex if (self.msIndex and self.msIndex.valid(self.mappings.numRows, mtime)) else None
+                with plotiterator.Iterators[self.selection.plotType] as p:
+                    s = NOW()
+                    pl = p.makePlots(self.msname, self.selection, self.mappings, readflags=self.readFlags, nproc=self.nproc,
+                                     prefetch=self.prefetch, memory=self.memory, index=index, mtime=mtime)
+                    e = NOW()
+                print "Data munching took\t{0:.3f}s".format( e-s )
+                try:
+                    self.plotCache.put(key, pl)
+                except Exception as E:
+                    print "Failed to store data in cache - {0}".format(E)
+            self.lastRead = (self.selectionState(mtime), pl)
 
         ## Make a new 'record' where we keep meta data + plots/data sets 
         ## with unmapped labels
@@ -1481,6 +1630,8 @@ class jplotter:
         S   = lambda env, deflt: E[env] if env in E else deflt 
 
         plotar2.msname        = CP(self.msname)
+        # the channel frequencies, such that drawing doesn't need the MS
+        plotar2.frequencies   = self.mappings.spectralMap.frequencyTable()
         plotar2.column        = CP(self.mappings.domain.column)
         plotar2.uniq          = ""
         plotar2.plotType      = CP(self.selection.plotType)
@@ -1537,6 +1688,61 @@ class jplotter:
             plotar2[label] = plots.plt_dataset(dataset.x, dataset.y, dataset.m)
         return plotar2
 
+    ## Capture the current selection such that we can later tell if
+    ## a new selection is a subset of it. Only baselines, sources and
+    ## time ranges may be narrowed, all other settings must be equal
+    def selectionState(self, mtime=None):
+        sel_ = self.selection
+        map_ = self.mappings
+        fixed = (os.path.abspath(self.msname), ms2util.tableModificationTime(self.msname) if mtime is None else mtime,
+                 sel_.plotType, CP(sel_.chanSel), CP(sel_.ddSelection), str(sel_.averageTime), str(sel_.averageChannel),
+                 sel_.solint, sel_.weightThreshold, self.readFlags, map_.domain.column, str(map_.spectralMap))
+        # explicit TaQL or scan selections can select anything; those we can't narrow
+        narrowable = not (sel_.taqlString or sel_.scanSel)
+        return (fixed, narrowable, CP(sel_.baselines), CP(sel_.sources), CP(sel_.timeRange))
+
+    ## If the current selection is a subset of the one that produced the data sets
+    ## we read most recently, return those data sets filtered by the current selection.
+    ## Returns None if the data must be read from disk
+    def narrowedPlots(self, mtime=None):
+        if self.lastRead is None:
+            return None
+        ((fixed, narrowable, bls, srcs, trs), pl) = self.lastRead
+        (nfixed, nnarrowable, nbls, nsrcs, ntrs) = self.selectionState(mtime)
+        if not (narrowable and nnarrowable and fixed==nfixed):
+            return None
+        # None means 'all'
+        subset = lambda new, old: old is None or (new is not None and set(new).issubset(set(old)))
+        if not (subset(nbls, bls) and subset(nsrcs, srcs)):
+            return None
+        # Time ranges can only be trimmed if the data sets are a function of time
+        # and no time averaging was done: averaged points may straddle the new boundaries
+        if ntrs!=trs:
+            sel_ = self.selection
+            if not (isinstance(plots.Plotters[sel_.plotType], plots.Quant2TimePlotter) and \
+                    sel_.solint is None and sel_.averageTime==AVG.None):
+                return None
+            if ntrs is None or not (trs is None or \
+                    all(map(lambda (s, e): any(map(lambda (ts, te): ts<=s and e<=te, trs)), ntrs))):
+                return None
+        # Now filter the data sets
+        blset  = None if nbls is None else set(nbls)
+        srcset = None if nsrcs is None else set(nsrcs)
+        rv     = {}
+        for (label, ds) in pl.iteritems():
+            if blset is not None and getattr(label, jenums.Axes.BL.value) not in blset:
+                continue
+            if srcset is not None and getattr(label, jenums.Axes.SRC.value) not in srcset:
+                continue
+            if ntrs!=trs:
+                x   = numpy.asarray(ds.x)
+                idx = reduce(lambda acc, (s, e): acc | ((x>=s) & (x<=e)), ntrs, numpy.zeros(len(x), dtype=numpy.bool))
+                if not idx.any():
+                    continue
+                ds  = plotiterator.dataset(x[idx], numpy.asarray(ds.y)[idx], numpy.asarray(ds.m)[idx])
+            rv[ label ] = ds
+        return rv
+
     def organizeAsPlots(self, plts, np):
         # process a 'Dict[label] => dataset' into
         # 'Dict[plotlabel] =>  Dict[datasetlabel] => dataset'
@@ -1546,18 +1752,16 @@ class jplotter:
         # 1. find the axes that make up the plot label (data set label will be the rest)
         plotaxes = map(lambda (ax, nw): ax, filter(lambda (ax, nw): nw==True, np.iteritems()))
         splitter = plots.label_splitter(plotaxes)
-        # 2. Go through all of the plots and reorganize
-        def proc_ds(acc, (l, dataset)):
+        # 2. Go through all of the plots and reorganize. Only the labels and
+        #    the x/y ranges are done here; the data sets are prepared for
+        #    display when their plot is drawn
+        showSetting = self._showSetting
+        rv = parsers.copy_attributes(plots.plotset(lambda ds: ds.prepare_for_display(showSetting),
+                                                   lambda ds: ds.display_limits(showSetting)), plts)
+        for (l, dataset) in plts.iteritems():
             (plot_l, dataset_l) = splitter(l)
-            #print "Unflatten: {0} => {1}  {2}".format(l, plot_l, dataset_l)
-            #print "           {0} points".format( len(dataset.xval) )
-            ds = dataset.prepare_for_display( self._showSetting )
-            if ds is None:
-                return acc
-            acc.setdefault(plot_l, plots.Dict())[ dataset_l ] = ds
-            return acc
-        rv = parsers.copy_attributes(plots.Dict(), plts)
-        return reduce(proc_ds, plts.iteritems(), rv)
+            rv.add(plot_l, dataset_l, dataset)
+        return rv
 
     def processLabel(self, plts):
         # Version 2.0: Based on all the plot- and data set labels, come up
@@ -1579,7 +1783,7 @@ class jplotter:
             for (k,v) in plotlab.key():
                 plotattrs[k].add( v )
             # process all data sets in the current plot
-            for dslab in plts[plotlab].keys():
+            for dslab in plts.dslabels(plotlab):
                 # analyze the label
                 for (k,v) in dslab.key():
                     dsattrs[k].add( v )
@@ -1615,61 +1819,17 @@ class jplotter:
         return plts
 
 
-    def doMinMax(self, plts, **opts):
-        defaults = {'verbose': True}
-        defaults.update( **opts )
+    def doMinMax(self, plts):
         ## Per plot we must compile the min/max of both X, Y axes per type
         #   meta[ <plot> ][ <type> ]{'xmin': ... , 'xmax': ..., 'ymin':..., 'ymax':...}
         #       contains the x/y range per plot per type, based on all datasets in the plot
         #   limits[ <type> ]{'xmin':..., 'xmax':..., 'ymin':..., 'ymax':...}
         #       contains the global x/y range per type across all plots
-        DD            = collections.defaultdict
-        plts.meta     = DD(lambda: DD(plots.Dict))
-        plts.limits   = DD(plots.Dict)
-
-        what_to_show = self._showSetting
-        def reductor(acc, lds):
-            tref = acc[lds[0].TYPE]
-            lds1 = lds[1]
-            # We *know* that xlims/ylims exist because datasets that do not have
-            # any points in them are filtered out in organizeAsPlots()
-            xl         = lds1.xlims
-            yl         = lds1.ylims
-            tref[ 0 ].append( xl[0] ) # xmin
-            tref[ 1 ].append( xl[1] ) # xmax
-            tref[ 2 ].append( yl[0] ) # ymin
-            tref[ 3 ].append( yl[1] ) # ymax
-            return acc
-
-        s = NOW()
-        glimits = DD(lambda: (list(), list(), list(), list()))
-        for plotlab in plts.keys():
-            for (tp, mdata) in reduce(reductor, plts[plotlab].iteritems(), DD(lambda: (list(), list(), list(), list()))).iteritems():
-                mref      = plts.meta[plotlab][tp]
-                mref.xlim = (min(mdata[0]), max(mdata[1]))
-                mref.ylim = (min(mdata[2]), max(mdata[3]))
-                # append to global limits
-                glimits[tp][ 0 ].append( mref.xlim[0] )
-                glimits[tp][ 1 ].append( mref.xlim[1] )
-                glimits[tp][ 2 ].append( mref.ylim[0] )
-                glimits[tp][ 3 ].append( mref.ylim[1] )
-        # and set them
-        for (tp, mdata) in glimits.iteritems():
-            mref      = plts.limits[tp]
-            mref.xlim = (min(mdata[0]), max(mdata[1]))
-            mref.ylim = (min(mdata[2]), max(mdata[3]))
-        e = NOW()
-
-        if defaults['verbose']:
-            print "min/max processing took\t{0:.3f}s                ".format( e-s )
-
-        if False:
-            for k in plts.meta.keys():
-                print "META[",k,"]"
-                for d in plts.meta[k].keys():
-                    print "   DS[",d,"]/ x:",plts.meta[k][d].xlim," y:",plts.meta[k][d].ylim
-            for k in plts.limits.keys():
-                print "LIMITS[",k,"]/ x:",plts.limits[k].xlim," y:",plts.limits[k].ylim
+        # These are computed on demand from the ranges of the data sets
+        # recorded when the plots were organized, without preparing the
+        # data sets for display
+        plts.meta     = plots.plotmeta(plts)
+        plts.limits   = plots.plotlimits(plts)
         return plts
 
     def drawFunc(self, plotar, dev, fst, onePage=None, **opts):
@@ -1691,6 +1851,13 @@ class jplotter:
         self.mappings            = ms2mappings.mappings()
         self._showSetting        = FLAG.Unflagged
         self.readFlags           = True
+        self.nproc               = 1
+        self.prefetch            = 1
+        self.memory              = plotiterator.defaultMemory
+        self.align               = parsers.defaultAlign
+        # the data sets as read from disk + the selection they were read with
+        self.lastRead            = None
+        self.msIndex             = None
 
 
     def markedDirty(self, *args):
@@ -1879,6 +2046,41 @@ def run_plotter(cmdsrc, **kwargs):
               cb=lambda *args: j().uniqueMetaData(*args), \
               hlp=Help["uniq"]) )
 
+    # number of processes used for reading the data
+    c.addCommand( \
+        mkcmd(rx=re.compile(r"^nproc(\s+[0-9]+)?$"), id="nproc", \
+              args=lambda x: re.sub(r"^nproc\s*", "", x).split(), \
+              cb=lambda *args: j().numProc(*args), \
+              hlp=Help["nproc"]) )
+
+    # how many chunks of data to read ahead
+    c.addCommand( \
+        mkcmd(rx=re.compile(r"^prefetch(\s+[0-9]+)?$"), id="prefetch", \
+              args=lambda x: re.sub(r"^prefetch\s*", "", x).split(), \
+              cb=lambda *args: j().prefetchDepth(*args), \
+              hlp=Help["prefetch"]) )
+
+    # how much memory may be used for reading data
+    c.addCommand( \
+        mkcmd(rx=re.compile(r"^mem(\s+\S+)?$"), id="mem", \
+              args=lambda x: re.sub(r"^mem\s*", "", x).split(), \
+              cb=lambda *args: j().memoryCap(*args), \
+              hlp=Help["mem"]) )
+
+    # the meta data index of the MS
+    c.addCommand( \
+        mkcmd(rx=re.compile(r"^index(\s+\S+)?$"), id="index", \
+              args=lambda x: re.sub(r"^index\s*", "", x).split(), \
+              cb=lambda *args: j().indexSettings(*args), \
+              hlp=Help["index"]) )
+
+    # the on-disk data set cache
+    c.addCommand( \
+        mkcmd(rx=re.compile(r"^cache(\s+\S+)?$"), id="cache", \
+              args=lambda x: re.sub(r"^cache\s*", "", x).split(), \
+              cb=lambda *args: j().cacheSettings(*args), \
+              hlp=Help["cache"]) )
+
     # run indexr on the MS
     c.addCommand(
         mkcmd(rx=re.compile(r"^inde?xr$"), id="indexr",
@@ -2169,10 +2371,18 @@ def run_plotter(cmdsrc, **kwargs):
 
     # animation!
     # animate the plots by some third axis (=combination of attribute values)
-    rxAnimate = re.compile(r"^animate\s+(?P<expr>\S.*)$")
+    rxAnimate = re.compile(r"^animate\s+(?P<expr>\S.*?)(?P<fpsopt>\s+fps\s*=\s*(?P<fps>[0-9]+(\.[0-9]*)?))?$")
     def animate_fn(*args):
         if not foo[o.curdev].navigable():
             raise RuntimeError, "Animation only available on screen devices"
+        # strip the frame rate, if given, the parser doesn't know about it
+        mo  = rxAnimate.match(args[0])
+        fps = 0.7
+        if mo.group('fps'):
+            fps  = float(mo.group('fps'))
+            args = (args[0][:mo.start('fpsopt')],)
+            if fps<=0:
+                raise RuntimeError, "The frame rate must be > 0"
         # the parser might be fed with keywords - we may have to check if they are available
         tr = j().mappings.timeRange if j().mappings is not None else None
         # parse the expression and loop over the plots
@@ -2205,30 +2415,50 @@ def run_plotter(cmdsrc, **kwargs):
             raise RuntimeError, "After filtering there were no plots left to animate"
         # Now we group_by and organize each set as plots
         print "Preparing ", len(keys), " datasets for animation"
-        sequence = []
-        s_time = NOW()
-        for group_key, datakeyiter in itertools.groupby(keys, groupby_f): #groups:
-            tmp = j().processLabel( j().organizeAsPlots(parsers.ds_key_filter(the_plots, datakeyiter), j().getNewPlot()) )
+        groups = map(lambda (group_key, datakeyiter): list(datakeyiter), itertools.groupby(keys, groupby_f))
+        # The frames are prepared when they're first shown, such that
+        # playback starts as soon as the first one is ready
+        def mkframe(n):
+            tmp = j().processLabel( j().organizeAsPlots(parsers.ds_key_filter(the_plots, groups[n]), j().getNewPlot()) )
             if e.post_processing_fn:
                 e.post_processing_fn( tmp, j().mappings )
             # rerun this because things may have changed
-            j().doMinMax(tmp, verbose=False)
-            sequence.append( tmp )
-        e_time = NOW()
-        print "Preparing animation took\t{0:.3f}s                ".format( e_time - s_time )
+            j().doMinMax(tmp)
+            return tmp
+        sequence = []
+        s_time   = NOW()
+        def frames():
+            for f in sequence:
+                yield f
+            while len(sequence)<len(groups):
+                sequence.append( mkframe(len(sequence)) )
+                yield sequence[-1]
+                if len(sequence)==len(groups):
+                    print "Preparing animation took\t{0:.3f}s                ".format( NOW() - s_time )
+        # Each frame is drawn once, recording the PGPLOT calls; after that
+        # the recorded frame is replayed. Frames are kept as long as they fit
+        # in the memory cap (see "mem"), the ones that don't are redrawn
+        recorded = [None] * len(groups)
+        budget   = j().memory
         # loop indefinitely
-        fps = 0.7#3
         try:
             env().select()
             dT = 1.0/fps
             print "Press ^C to stop the animation [{0}fps]".format( fps )
             while True:
-                for (page, page_plots) in enumerate(sequence):
+                for (page, page_plots) in enumerate(frames()):
                     # we really would like to have all plots on one page
                     # TODO: expand nx/ny to accomodate this?
                     s = NOW()
                     with plots.pgenv(ppgplot) as p:
-                        j().drawFunc(page_plots, ppgplot, 0, plots.AllInOne, ncol=env().devNColor)
+                        if recorded[page] is not None:
+                            recorded[page].replay()
+                        else:
+                            rec = plots.pgrecorder(ppgplot)
+                            j().drawFunc(page_plots, rec, 0, plots.AllInOne, ncol=env().devNColor, verbose=False)
+                            if rec.nbytes<=budget:
+                                recorded[page] = rec
+                                budget        -= rec.nbytes
                     while True:
                         nsec = (s + dT) - NOW()
                         if nsec<=0:
@@ -2486,7 +2716,7 @@ def run_plotter(cmdsrc, **kwargs):
         # set current plots as default
         e = env()
         datasets['_'] = prevplt = e.rawplots
-        parsers.parse_dataset_expr(expr, datasets)
+        parsers.parse_dataset_expr(expr, datasets, align=j().align)
         e.rawplots    = datasets['_']
         # plots replaced? replot
         if isinstance(e.rawplots, type({})) and e.rawplots is not prevplt:
@@ -2498,13 +2728,19 @@ def run_plotter(cmdsrc, **kwargs):
             return show_vars_fn()
         e = env()
         prevplt    = e.rawplots
-        e.rawplots = parsers.parse_dataset_expr(expr, datasets)
+        e.rawplots = parsers.parse_dataset_expr(expr, datasets, align=j().align)
         if isinstance(e.rawplots, type({})):
             print "loaded: {0} datasets into current".format( len(e.rawplots) )
             # and redraw if necessary
             if prevplt is not e.rawplots:
                 refresh_after_reload(e)
 
+    # how data sets are aligned when combined in store/load expressions
+    c.addCommand( \
+            mkcmd(rx=re.compile(r"^align(\s+\S+){0,2}$"), id="align", \
+                  args=lambda x: re.sub(r"^align\s*", "", x).split(), \
+                  cb=lambda *args: j().alignment(*args), \
+                  hlp=Help["align"]) )
     c.addCommand( \
             mkcmd(rx=re.compile(r"^store\b.*"), id="store", args=lambda x:x,
                   cb=store_fn, hlp=Help["store"]) )
@@ -1,4 +1,4 @@
-import collections, jenums
+import collections, jenums, numpy
 
 AX        = jenums.Axes
 
@@ -43,3 +43,46 @@ class label(BaseClass):
 
     def __repr__(self):
         return "/".join( [_fmt[n](_attrf[n], self[n]) for n in _nattrf if self[n] is not None] )
+
+
+## A columnar table of labels: per attribute, for each label, the index of
+## its value in the list of distinct values of that attribute ("code").
+## Functions of (some of) the attributes of a label then only need to be
+## evaluated once per distinct combination of the values of those
+## attributes in stead of once per label.
+## Attributes are given by name ('P', 'CH', ..., 'TYPE'), None means all.
+class labeltable(object):
+    def __init__(self, labels):
+        self.labels = list(labels)
+        self.codes  = dict()
+        for (n, a) in enumerate(BaseClass._fields):
+            index = dict()
+            self.codes[a] = numpy.fromiter((index.setdefault(l[n], len(index)) for l in self.labels),
+                                           dtype=numpy.int64, count=len(self.labels))
+        self.cache  = dict()
+
+    def __len__(self):
+        return len(self.labels)
+
+    # Returns (group, first): for each label the number of its distinct
+    # combination of values of 'attrs' and, for each such combination,
+    # the index of the first label having it
+    def groups(self, attrs=None):
+        attrs = tuple(BaseClass._fields if attrs is None else sorted(set(attrs)))
+        if attrs not in self.cache:
+            group = numpy.zeros(len(self.labels), dtype=numpy.int64)
+            for a in attrs:
+                # keep the combined code compact
+                group = numpy.unique(group * (self.codes[a].max()+1 if len(self.labels) else 1) + self.codes[a], return_inverse=True)[1]
+            (u, first) = numpy.unique(group, return_index=True)
+            self.cache[attrs] = (group, first)
+        return self.cache[attrs]
+
+    # fn(label) for all labels, evaluated once per distinct combination
+    # of values of 'attrs', the attributes 'fn' depends on
+    def apply(self, fn, attrs=None):
+        (group, first) = self.groups(attrs)
+        values         = numpy.empty(len(first), dtype=object)
+        for (n, i) in enumerate(first):
+            values[n] = fn(self.labels[i])
+        return values[group]
@@ -51,7 +51,60 @@
 # Revision 1.2  2013-01-29 12:23:45  jive_cc
 # HV: * time to commit - added some more basic stuff
 #
-import sys, ms2util, jenums
+import sys, os, ms2util, jenums, hashlib, tempfile, cPickle, cStringIO
+
+## The mappings of an MS (and other meta data derived from it, like the
+## scan list) are cached on disk, such that re-opening an unchanged MS does
+## not require scanning it again. Each entry is stored with a key, e.g.
+## the MS' path, modification time, number of rows and the options used to
+## create the mappings; the entry is only used if the key is the same.
+def cachePath():
+    return os.path.join(os.getenv('HOME'), ".jplotter.cache", "meta")
+
+def cacheFile(nm, kind):
+    return os.path.join(cachePath(), hashlib.sha1(os.path.abspath(nm)).hexdigest()+"."+kind)
+
+# The data domain is an enumeration value; those must be pickled by name
+# in order to get the identical object back after unpickling
+_enumById   = dict(map(lambda e: (id(e), "Type."+str(e)), jenums.Type))
+_enumByName = dict(map(lambda e: ("Type."+str(e), e), jenums.Type))
+
+def _dumps(o):
+    f = cPickle.Pickler(cPickle.HIGHEST_PROTOCOL)
+    f.persistent_id = lambda x: _enumById.get(id(x), None)
+    f.dump(o)
+    return f.getvalue()
+
+def _loads(s):
+    f = cPickle.Unpickler(cStringIO.StringIO(s))
+    f.persistent_load = _enumByName.__getitem__
+    return f.load()
+
+## Return the cached value or None if not cached/different key
+def cacheGet(nm, kind, key):
+    fn = cacheFile(nm, kind)
+    if not os.path.isfile(fn):
+        return None
+    try:
+        with open(fn, 'rb') as f:
+            (k, value) = _loads(f.read())
+    except Exception as E:
+        print "{0}: failed to read cached meta data {1} - {2}".format(kind, fn, E)
+        return None
+    return value if k==key else None
+
+def cachePut(nm, kind, key, value):
+    if not os.path.isdir(cachePath()):
+        os.makedirs(cachePath())
+    (fd, tmp) = tempfile.mkstemp(dir=cachePath())
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write( _dumps((key, value)) )
+        os.rename(tmp, cacheFile(nm, kind))
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
 
 class FailedToLoadMS(Exception):
     def __init__(self, ms):
@@ -69,6 +122,26 @@ class mappings:
                and self.fieldMap and self.timeRange and self.domain is not None \
                and self.project
 
+    _attrs = ['spectralMap', 'baselineMap', 'polarizationMap', 'fieldMap', 'timeRange', 'domain', 'project', 'numRows']
+
+    ## The options that influence the mappings
+    @staticmethod
+    def cacheKey(nm, nrow, options):
+        return (os.path.abspath(nm), ms2util.tableModificationTime(nm), nrow,
+                sorted(filter(lambda (k, v): k not in ['nproc', 'meta', 'cache'], options.iteritems())))
+
+    ## Returns True if the mappings could be loaded from the cache
+    def loadCached(self, nm, nrow, options):
+        attrs = cacheGet(nm, "mappings", mappings.cacheKey(nm, nrow, options))
+        if attrs is None:
+            return False
+        self.reset()
+        map(lambda (a, v): setattr(self, a, v), attrs.iteritems())
+        return True
+
+    def storeCached(self, nm, options):
+        cachePut(nm, "mappings", mappings.cacheKey(nm, self.numRows, options), dict(map(lambda a: (a, getattr(self, a)), mappings._attrs)))
+
     def reset(self):
         self.spectralMap     = None
         self.baselineMap     = None
@@ -114,20 +187,29 @@ class mappings:
                 if ans=="n":
                     raise RuntimeError, "Opening of MS cancelled by user"
 
+            # if the MS did not change since we last saw it, no need to scan it
+            if options.get('cache', True) and self.loadCached(nm, len(m), options):
+                return
+
             def logit(x):
                 sys.stdout.write("{0} ... {1}                            \r".format(nm, x))
                 sys.stdout.flush()
 
+            # read the main table meta data columns only once; all
+            # mappings are derived from the result of that scan
+            logit("main table         1/6")
+            options['meta'] = ms2util.scanMainTable(nm, **options)
+
             # start reading the mappings
-            logit("spectral map       1/5")
+            logit("spectral map       2/6")
             spectralMap     = ms2util.makeSpectralMap(nm, **options)
-            logit("baseline map       2/5")
+            logit("baseline map       3/6")
             baselineMap     = ms2util.makeBaselineMap(nm, **options)
-            logit("polarization map   3/5")
+            logit("polarization map   4/6")
             polarizationMap = ms2util.makePolarizationMap(nm, **options)
-            logit("field map          4/5")
+            logit("field map          5/6")
             fieldMap        = ms2util.makeFieldMap(nm, **options)
-            logit("timerange          5/5")
+            logit("timerange          6/6")
             timeRange       = ms2util.getTimeRange(nm, **options)
             domain          = ms2util.getDataDomain(nm, **options)
             project         = ms2util.getProject(nm, **options)
@@ -145,3 +227,7 @@ class mappings:
             self.project         = project
             self.numRows         = len(m)
 
+        try:
+            self.storeCached(nm, options)
+        except Exception as E:
+            print "mappings: failed to cache meta data - {0}".format(E)
@@ -118,7 +118,7 @@
 #  Revision 1.1.1.1  2001/04/06 13:34:34  verkout
 #  Files, new + from jivegui/MS1
 import itertools, operator, math, re, jenums, hvutil, numpy, pyrap.tables, pyrap.quanta, sys
-import datetime, copy, collections
+import datetime, copy, collections, multiprocessing, threading, Queue, os
 
 # Return a nicely human readable string representation
 # of a MS::TIME column value
@@ -436,6 +436,12 @@ class spectralmap:
         except IndexError:
             raise InvalidSubband(sb)
 
+    # All channel frequencies in a plain dict, indexed by (FREQGROUP, SUBBAND)
+    # where FREQGROUP may be the number or the name, like above
+    def frequencyTable(self):
+        return dict(((k, sb), numpy.array(spw.frequency)) for (fqkey, sbs) in self.spectralMap.iteritems()
+                                                          for (sb, spw) in sbs for k in fqkey)
+
     # Id. for NUMCHAN
     def numchanOfSPW(self, spwid):
         try:
@@ -620,6 +626,73 @@ def assertMinimalMS(nm):
     if ti['type']!='Measurement Set':
         raise NotAMeasurementSet(nm)
 
+## A table is a directory; any modification of the table modifies
+## (at least) one of the files in there. The subtables (ANTENNA,
+## SPECTRAL_WINDOW, FIELD, ...) are subdirectories, so changes to those
+## are found by looking at their files as well. Return the most recent
+## modification time of all the table's files and directories.
+## The lock files (table.lock) are touched by merely opening the table
+## so those don't count
+def tableModificationTime(nm):
+    return max(map(lambda (d, dirs, files): max([os.path.getmtime(d)] + map(lambda f: os.path.getmtime(os.path.join(d, f)),
+                                                                             filter(lambda f: not f.endswith(".lock"), files))),
+                   os.walk(nm)))
+
+
+## Everything the mapping functions need to know from the main table,
+## collected in one pass over the meta data columns. With 'unique' the
+## used baselines, data description ids and fields are collected too.
+## The pass is done in chunks and can be done in parallel; partial
+## results are merged.
+class mainmeta(object):
+    # baselines are collected as a code: ANTENNA1 * _blmul + ANTENNA2
+    _blmul = 65536
+
+    def __init__(self, unique=False):
+        self.columns   = (["ANTENNA1", "ANTENNA2", "DATA_DESC_ID", "FIELD_ID"] if unique else []) + ["TIME", "EXPOSURE"]
+        self.blcodes   = numpy.array([], dtype=numpy.int64)
+        self.ddids     = numpy.array([], dtype=numpy.int64)
+        self.fieldids  = numpy.array([], dtype=numpy.int64)
+        self.exposures = numpy.array([], dtype=numpy.float64)
+        self.start     = None
+        self.end       = None
+
+    def span(self, s, e):
+        self.start = s if self.start is None else min(self.start, s)
+        self.end   = e if self.end is None else max(self.end, e)
+
+    def add(self, *cols):
+        c = dict(zip(self.columns, cols))
+        if "ANTENNA1" in c:
+            self.blcodes  = numpy.union1d(self.blcodes, numpy.asarray(c["ANTENNA1"], dtype=numpy.int64)*mainmeta._blmul + c["ANTENNA2"])
+            self.ddids    = numpy.union1d(self.ddids, c["DATA_DESC_ID"])
+            self.fieldids = numpy.union1d(self.fieldids, c["FIELD_ID"])
+        self.exposures = numpy.union1d(self.exposures, c["EXPOSURE"])
+        if len(c["TIME"]):
+            self.span(numpy.amin(c["TIME"]), numpy.amax(c["TIME"]))
+        return self
+
+    def merge(self, other):
+        self.blcodes   = numpy.union1d(self.blcodes, other.blcodes)
+        self.ddids     = numpy.union1d(self.ddids, other.ddids)
+        self.fieldids  = numpy.union1d(self.fieldids, other.fieldids)
+        self.exposures = numpy.union1d(self.exposures, other.exposures)
+        if other.start is not None:
+            self.span(other.start, other.end)
+        return self
+
+    def baselines(self):
+        return map(lambda code: divmod(code, mainmeta._blmul), self.blcodes)
+
+    def antennas(self):
+        return set(self.blcodes / mainmeta._blmul) | set(self.blcodes % mainmeta._blmul)
+
+def scanMainTable(nm, **kwargs):
+    meta = mainmeta(kwargs.get('unique', False))
+    with opentable(nm) as tbl:
+        return reducems2(lambda acc, *cols: acc.add(*cols), tbl, meta, meta.columns,
+                         chunksize=kwargs.get('chunksize', 1000000), nproc=kwargs.get('nproc', 1),
+                         reopen=lambda: opentable(nm), merge=lambda acc, part: acc.merge(part))
 
 def makeSpectralMap(nm, **kwargs):
     errf    = hvutil.mkerrf("makeSpectralMap({0})".format(nm))
@@ -738,7 +811,10 @@ def makeSpectralMap(nm, **kwargs):
                     # numpy.unique( tbl.getcol('DATA_DESC_ID') )              takes  0.64s  (   ..  )
                     #
                     # Looks like we have a winner!
-                    spmap = reduce(reductor, numpy.unique( tbl.getcol('DATA_DESC_ID') ), {})
+                    #
+                    # Even better: if the main table was already scanned, use that
+                    meta  = kwargs.get('meta', None)
+                    spmap = reduce(reductor, meta.ddids if meta else numpy.unique( tbl.getcol('DATA_DESC_ID') ), {})
                 # do not forget to sort all subbands by frequency
                 sort_order = kwargs.get('spw_order', 'by_frequency').lower()
 
@@ -855,21 +931,27 @@ def makeBaselineMap(nm, **kwargs):
                 #
                 #uniqry    = lambda col: set(pyrap.tables.taql("SELECT {0} AS FOO from $tbl".format(col), locals={"tbl":tbl}).getcol("FOO"))
                 #ants      = uniqry("ANTENNA1") | uniqry("ANTENNA2")
-                a1        = tbl.getcol('ANTENNA1')
-                a2        = tbl.getcol('ANTENNA2')
-                ants      = set(numpy.unique(a1)) | set(numpy.unique(a2))
+                meta      = kwargs.get('meta', None)
+                if meta:
+                    # the main table was already scanned
+                    ants      = meta.antennas()
+                    baselines = meta.baselines()
+                else:
+                    a1        = tbl.getcol('ANTENNA1')
+                    a2        = tbl.getcol('ANTENNA2')
+                    ants      = set(numpy.unique(a1)) | set(numpy.unique(a2))
+                    # retrieve the uniqe baselines. This also takes a LOOOONG time
+                    # so we gonna do it mighty different.
+                    # since we already have ANTENNA1, ANTENNA2 columns we're going
+                    # to play a neat trick.
+                    # Using numpy we multiply antenna1 by 1000 and add antenna2
+                    # so we have an array of baseline codes (integers).
+                    # Then we uniquefy those and translate them back to
+                    # tuples with antenna indices
+                    maxant    = max(ants)+1
+                    make_tup  = lambda blcode: (blcode/maxant, blcode%maxant)
+                    baselines = map(make_tup, numpy.unique(numpy.add(numpy.multiply(a1, maxant), a2)))
                 filter_f  = lambda x : x in ants
-                # retrieve the uniqe baselines. This also takes a LOOOONG time
-                # so we gonna do it mighty different.
-                # since we already have ANTENNA1, ANTENNA2 columns we're going
-                # to play a neat trick.
-                # Using numpy we multiply antenna1 by 1000 and add antenna2
-                # so we have an array of baseline codes (integers).
-                # Then we uniquefy those and translate them back to
-                # tuples with antenna indices
-                maxant    = max(ants)+1
-                make_tup  = lambda blcode: (blcode/maxant, blcode%maxant)
-                baselines = map(make_tup, numpy.unique(numpy.add(numpy.multiply(a1, maxant), a2)))
 
             names = antab.getcol('NAME')
 
@@ -1062,7 +1144,8 @@ def makeFieldMap(nm, **kwargs):
                 #    field_ids = set(pyrap.tables.taql("select unique FIELD_ID from $tbl", locals={"tbl":tbl}).getcol("FIELD_ID"))
                 # fast method (not really, we make it even faster ... see other functions with timings)
                 #field_ids = set(tbl.getcol("FIELD_ID"))
-                field_ids = numpy.unique(tbl.getcol('FIELD_ID'))
+                meta      = kwargs.get('meta', None)
+                field_ids = meta.fieldids if meta else numpy.unique(tbl.getcol('FIELD_ID'))
                 filter_f  = lambda (fld, nm): fld in field_ids
 
             get_name = lambda x: x['NAME']
@@ -1072,13 +1155,14 @@ def makeFieldMap(nm, **kwargs):
 ##
 ##  Time'server' - get timerange from a measurementset
 ##
+class startend:
+    def __init__(self, st, en, ti):
+        self.start = st
+        self.end   = en
+        self.inttm = ti
+
 def getTimeRange(nm, **kwargs):
     errf   = hvutil.mkerrf("getTimeRange({0})".format(nm))
-    class startend:
-        def __init__(self, st, en, ti):
-            self.start = st
-            self.end   = en
-            self.inttm = ti
     with opentable(nm) as tbl:
         if len(tbl)==0:
             return errf("No rows in table!")
@@ -1102,6 +1186,11 @@ def getTimeRange(nm, **kwargs):
         # Thus the fastest way to get the full time range of an MS is to read the
         # whole TIME column and go through the array *twice* [using numpy ...]
         # to find the minimum and the maximum separately.
+        #
+        # If the main table was already scanned, we have the answers
+        meta  = kwargs.get('meta', None)
+        if meta:
+            return startend(meta.start, meta.end, list(meta.exposures))
         utms  = numpy.unique(tbl.getcol('TIME'))
         return startend(numpy.amin(utms), numpy.amax(utms), list(numpy.unique(tbl.getcol('EXPOSURE'))))
 
@@ -1136,38 +1225,71 @@ class scan(object):
         return "{0:3d}: {1} {2: 3d}m{3:.2f}s dT:{4:5.2f}s {5:<15s} ({6}) (ARRAY_ID {7})".format(
             self.scan_number, as_time(self.start), int(m), s, self.t_int, self.field, self.field_id, self.array_id)
 
+## Both indexers read the columns they need in chunks (in parallel if
+## kwargs 'nproc'>1) and reduce each chunk into a small array of groups.
+## Partial results are concatenated and grouped again. numpy.lexsort is
+## stable, so the first row of each group is the first row in the MS.
+
+## Reduce to one entry per (ARRAY_ID, SCAN_NUMBER), keeping the field and
+## exposure of the first row and the minimum/maximum time
+def _scangroups(arr, sn, fld, exp, tmin, tmax):
+    if not len(arr):
+        return (arr, sn, fld, exp, tmin, tmax)
+    order  = numpy.lexsort( (sn, arr) )
+    (arr, sn, fld, exp, tmin, tmax) = map(lambda a: a[order], (arr, sn, fld, exp, tmin, tmax))
+    starts = numpy.flatnonzero( numpy.r_[True, (arr[1:]!=arr[:-1]) | (sn[1:]!=sn[:-1])] )
+    return (arr[starts], sn[starts], fld[starts], exp[starts], numpy.minimum.reduceat(tmin, starts), numpy.maximum.reduceat(tmax, starts))
+
+## Reduce to the sorted unique combinations of the columns
+def _uniquerows(*cols):
+    if not len(cols[0]):
+        return cols
+    order  = numpy.lexsort( cols[::-1] )
+    cols   = map(lambda a: a[order], cols)
+    starts = numpy.flatnonzero( numpy.r_[True, reduce(operator.or_, map(lambda a: a[1:]!=a[:-1], cols))] )
+    return tuple(map(lambda a: a[starts], cols))
+
+def _concat(acc, part):
+    return map(numpy.concatenate, zip(acc, part))
+
+# 'merge' combines two accumulated values; by default the partial
+# result is fed to 'function' as if it were columns read from the table
+def _reducecols(msname, columns, function, init, merge=None, **kwargs):
+    with opentable(msname) as ms:
+        return reducems2(function, ms, init, columns, chunksize=kwargs.get('chunksize', 1000000),
+                         nproc=kwargs.get('nproc', 1), reopen=lambda: opentable(msname),
+                         merge=merge if merge is not None else lambda acc, part: function(acc, *part))
+
+def indexr(msname, **kwargs):
+    emptyf = numpy.array([], dtype=numpy.float64)
+    emptyi = numpy.array([], dtype=numpy.int32)
+    # TIME is read once and serves as both start and end time of the rows
+    scans  = _reducecols(msname, ["ARRAY_ID", "SCAN_NUMBER", "FIELD_ID", "EXPOSURE", "TIME"],
+                         lambda acc, arr, sn, fld, exp, tm: _scangroups(*_concat(acc, (arr, sn, fld, exp, tm, tm))),
+                         (emptyi, emptyi, emptyi, emptyf, emptyf, emptyf),
+                         merge=lambda acc, part: _scangroups(*_concat(acc, part)), **kwargs)
+    return map(lambda (aid, sn, fld, exp, s, e): scan(aid, sn, fld, s, e, exp), zip(*scans))
+
+
 ## fudge is the gap time in number of integration times after which we decide
 ## there is a new scan [that is, if there is no change in field]. So a discontinuity
 ## in the TIME axis longer than "fudge * EXPOSURE" w/o change in field and/or array
 ## will start a new scan
-def indexr(msname, **kwargs):
-    rv = []
-    ag = operator.itemgetter('SCAN_NUMBER', 'ARRAY_ID', 'FIELD_ID', 'EXPOSURE')
-    with opentable(msname) as ms:
-        ti = ms.iter(["ARRAY_ID", "SCAN_NUMBER"])
-        for tab in ti:
-            (sn, aid, fld, exp) = ag(tab[0])
-            tms                 = tab.getcol('TIME')
-            rv.append( scan(aid, sn, fld, numpy.min(tms), numpy.max(tms), exp) )
-        return rv
-
-
-def indexr_heur(msname, fudge=2.1):
-    ac = []
-    ag = operator.itemgetter('ARRAY_ID', 'TIME', 'FIELD_ID', 'EXPOSURE')
-    with opentable(msname) as ms:
-        arr, tm, fld, exp = ag(ms[0])
-        ac.append( scan(arr, fld, tm, exp) )
-        ti = ms.iter(["ARRAY_ID", "TIME", "FIELD_ID", "EXPOSURE"])
-        for tab in ti:
-            arr, tm, fld, exp = ag(tab[0])
-            delta = abs(fudge*exp)
-            last  = ac[-1]
-            if last.field_id!=fld or ((last.start-delta)>tm or (last.end+delta)<tm):
-                # new scan
-                ac.append( scan(arr, fld, tm, exp) )
-            ac[-1].end = tm
-        return sorted(ac, key=scan.sortOrder)
+def indexr_heur(msname, fudge=2.1, **kwargs):
+    emptyf = numpy.array([], dtype=numpy.float64)
+    emptyi = numpy.array([], dtype=numpy.int32)
+    (arr, tm, fld, exp) = _reducecols(msname, ["ARRAY_ID", "TIME", "FIELD_ID", "EXPOSURE"],
+                                      lambda acc, *cols: _uniquerows(*_concat(acc, cols)),
+                                      (emptyi, emptyf, emptyi, emptyf), **kwargs)
+    if not len(arr):
+        return []
+    # A new scan starts if the array or field changes or if the
+    # gap in time is larger than 'fudge' integration times
+    new    = numpy.r_[True, (arr[1:]!=arr[:-1]) | (fld[1:]!=fld[:-1]) | ((tm[1:]-tm[:-1])>numpy.abs(fudge*exp[1:]))]
+    starts = numpy.flatnonzero(new)
+    ends   = numpy.r_[starts[1:], len(tm)] - 1
+    return sorted(map(lambda (n, s, e): scan(arr[s], n+1, fld[s], tm[s], tm[e], exp[s]), zip(itertools.count(), starts, ends)),
+                  key=scan.sortOrder)
 
 ##  DataDomain stuff.
 ##  Provide for routine that attempts to
@@ -1177,6 +1299,11 @@ knownColumns = { 'DATA':  jenums.Type.Spectral,
         'MODEL_DATA':     jenums.Type.Spectral,
         'CORRECTED_DATA': jenums.Type.Spectral }
 
+class datadomain:
+    def __init__(self, domain, column):
+        self.domain = domain
+        self.column = column
+
 def getDataDomain(ms, **kwargs):
     with opentable(ms) as tbl:
         colnames   = tbl.colnames()
@@ -1197,7 +1324,7 @@ def getDataDomain(ms, **kwargs):
                 raise RuntimeError, "The column {0} is not available in the MS".format( candidates[0] )
 
         # return an object with attributes .domain and .column
-        return type('',(),{'domain': knownColumns.get(thecolumn, jenums.Type.Unknown), 'column':thecolumn})()
+        return datadomain(knownColumns.get(thecolumn, jenums.Type.Unknown), thecolumn)
 
 ## Return the project code from the MS
 ## Currently only the first one is returned
@@ -1317,10 +1444,138 @@ def reducems_raw(function, ms, init, columns, **kwargs):
 ##     function(acc, col1, col2, col3, ..., coln)
 ## With 'colN' having the column data for a block of columns
 ## so 'function' must iterate over the elements itself
+##
+## Parallel mode: pass 'nproc=N' (N>1) together with
+##    'reopen=fn()'        a function returning a (new) table object that
+##                         has the same rows, in the same order, as 'ms'
+##                         (e.g. by re-executing the same query)
+##    'merge=fn(acc, p)'   a function that merges a partial result 'p' into
+##                         the accumulator and returns the accumulator
+## and optionally
+##    'finish=fn(acc)'     a function that is called in the worker process
+##                         to turn the accumulator into the partial result
+##                         that is sent back (default: the accumulator itself)
+## The table is split into disjoint, consecutive, row ranges; each worker
+## process opens the table itself and reduces its range(s), starting from a copy
+## of 'init'. The partial results are merged in row order.
+##
+## Prefetching: pass 'prefetch=N' (N>0) to have a background thread read
+## the columns of up to N chunks ahead, while 'function' is processing the
+## current chunk. 'prefetch=0' reads and processes the chunks alternately.
 def reducems2(function, ms, init, columns, **kwargs):
     # allow user to override for specific column (pass function/4 in via 'slicer' kwarg)
     slicers = kwargs.get('slicers', {})
     chunksz = kwargs.get('chunksize', 5000)
+    nproc   = kwargs.get('nproc', 1)
+    depth   = kwargs.get('prefetch', 0)
     fns     = map(lambda col: (col, slicers.get(col, lambda tab, c, s, n: tab.getcol(c, startrow=s, nrow=n))), columns)
-    return reduce(lambda acc, (i, cs): function(acc, *map(lambda (c, f): f(ms, c, i, cs), fns)),
-                  chunkert(0, len(ms), chunksz, verbose=kwargs.get('verbose', False)), init)
+    if nproc>1 and len(ms)>chunksz and 'reopen' in kwargs and 'merge' in kwargs:
+        return reducems2_parallel(function, len(ms), init, fns, chunksz, **kwargs)
+    return reduce(lambda acc, cols: function(acc, *cols),
+                  chunkreader(ms, fns, chunkert(0, len(ms), chunksz, verbose=kwargs.get('verbose', False)), depth), init)
+
+## Generate the column data for each (startrow, nrow) chunk.
+## With depth>0 the data is read by a background thread, at most
+## 'depth' chunks ahead of the consumer.
+def chunkreader(tab, fns, chunks, depth=0):
+    getcols = lambda (i, cs): map(lambda (c, f): f(tab, c, i, cs), fns)
+    if depth<=0:
+        for chunk in chunks:
+            yield getcols(chunk)
+        return
+    q    = Queue.Queue(depth)
+    stop = threading.Event()
+    # the reader thread sends (True, <columns>) for each chunk, (False, None)
+    # when done and (False, <exception info>) if something went wrong
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+    def reader():
+        try:
+            for chunk in chunks:
+                if not put( (True, getcols(chunk)) ):
+                    return
+            put( (False, None) )
+        except:
+            put( (False, sys.exc_info()) )
+    thr = threading.Thread(target=reader)
+    thr.daemon = True
+    thr.start()
+    try:
+        while True:
+            (ok, item) = q.get()
+            if ok:
+                yield item
+            elif item is None:
+                break
+            else:
+                raise item[0], item[1], item[2]
+    finally:
+        # also executed if the consumer stops early
+        stop.set()
+        thr.join()
+
+## Return the number of bytes one row of the columns takes, after slicing.
+## Determined by actually reading the first row through the column getters.
+def rowsize(tab, columns, **kwargs):
+    slicers = kwargs.get('slicers', {})
+    getcol  = lambda tab, c, s, n: tab.getcol(c, startrow=s, nrow=n)
+    return sum(map(lambda col: numpy.asarray(slicers.get(col, getcol)(tab, col, 0, 1)).nbytes, columns))
+
+## How many rows to read per chunk such that the column data takes
+## at most 'budget' bytes per chunk
+def chunksize_for(tab, columns, budget, **kwargs):
+    if not len(tab):
+        return 1
+    return max(1, min(len(tab), int(budget/max(1, rowsize(tab, columns, **kwargs)))))
+
+## Whatever the worker processes need to know is stored in here before the
+## process pool is created; the workers inherit it through fork(2) such that
+## only the row ranges need to be sent to them (functions with lambdas
+## cannot be pickled)
+_reducems2_job = None
+
+def _reducems2_worker( (f, l) ):
+    (function, reopen, finish, init, fns, chunksz, depth) = _reducems2_job
+    tab = reopen()
+    try:
+        acc = reduce(lambda acc, cols: function(acc, *cols),
+                     chunkreader(tab, fns, chunkert(f, l, chunksz, verbose=False), depth), copy.deepcopy(init))
+    finally:
+        tab.close()
+    return finish(acc)
+
+def reducems2_parallel(function, nrow, init, fns, chunksz, **kwargs):
+    global _reducems2_job
+    def log(msg):
+        sys.stdout.write(msg+" "*10+"\r")
+        sys.stdout.flush()
+    logfn  = log if kwargs.get('verbose', False) else lambda x: None
+    # Cut the table in row ranges of an integer amount of chunks. Make
+    # a few more ranges than processes such that they're evenly loaded
+    nchunk = (nrow + chunksz - 1)/chunksz
+    step   = max(1, nchunk/(4*kwargs['nproc'])) * chunksz
+    ranges = map(lambda f: (f, min(f+step, nrow)), xrange(0, nrow, step))
+    merge  = kwargs['merge']
+    _reducems2_job = (function, kwargs['reopen'], kwargs.get('finish', lambda acc: acc), init, fns, chunksz, kwargs.get('prefetch', 0))
+    pool   = multiprocessing.Pool( min(kwargs['nproc'], len(ranges)) )
+    try:
+        acc = init
+        # imap() returns the results in the order of the ranges
+        for (n, part) in enumerate(pool.imap(_reducems2_worker, ranges)):
+            logfn(progress(ranges[n][1], 0, nrow, 50))
+            acc = merge(acc, part)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _reducems2_job = None
+    logfn(" "*80)
+    return acc
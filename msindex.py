@@ -0,0 +1,137 @@
+# The "jplotter index" of a MeasurementSet
+#
+# Every plot needs the small meta data columns of the main table (antennas,
+# time, data description id, field id) and a selection on those. Reading
+# them through casacore and running a TaQL query for each plot is slow on
+# large data sets. The index holds a copy of these columns as flat '.npy'
+# arrays, which are memory mapped when used, plus a per-row baseline code
+# (1000*ANTENNA1 + ANTENNA2, like the baseline TaQL uses). Selections can
+# then be evaluated as numpy boolean masks.
+#
+# The index is built on request (it requires one pass over the meta data
+# columns) and stored in a directory per MS. It records the MS' modification
+# time and number of rows; if either of those changed, the index is stale
+# and will not be used.
+import os, json, hashlib, numpy, tempfile, shutil, ms2util
+
+## The columns we copy and the type they're stored as
+_columns = [("ANTENNA1", numpy.int32), ("ANTENNA2", numpy.int32), ("TIME", numpy.float64),
+            ("DATA_DESC_ID", numpy.int32), ("FIELD_ID", numpy.int32), ("ARRAY_ID", numpy.int32),
+            ("SCAN_NUMBER", numpy.int32), ("FLAG_ROW", numpy.bool)]
+_blcode  = ("BLCODE", numpy.int32)
+
+def baselineCode(a1, a2):
+    return 1000*a1 + a2
+
+def defaultPath():
+    return os.path.join(os.getenv('HOME'), ".jplotter.cache", "index")
+
+## Where the index for MS 'msname' lives
+def indexDir(msname, path=None):
+    return os.path.join(path if path else defaultPath(), hashlib.sha1(os.path.abspath(msname)).hexdigest())
+
+class msindex(object):
+    def __init__(self, msname, path=None):
+        self.msname = os.path.abspath(msname)
+        self.dir    = indexDir(msname, path)
+        self.meta   = None
+        self.cols   = {}
+
+    def metaFile(self):
+        return os.path.join(self.dir, "meta.json")
+
+    def exists(self):
+        return os.path.isfile(self.metaFile())
+
+    ## The index is only valid if the MS did not change since it was built.
+    ## Pass the MS' modification time if it is already known
+    def valid(self, nrow=None, mtime=None):
+        if not self.exists():
+            return False
+        with open(self.metaFile()) as f:
+            meta = json.load(f)
+        if meta['mtime']!=(ms2util.tableModificationTime(self.msname) if mtime is None else mtime):
+            return False
+        return nrow is None or meta['nrow']==nrow
+
+    ## Memory map the arrays. Returns ourselves or None if no (valid) index
+    def open(self, nrow=None):
+        if not self.valid(nrow):
+            return None
+        with open(self.metaFile()) as f:
+            self.meta = json.load(f)
+        self.cols = dict(map(lambda (c, t): (c, numpy.load(os.path.join(self.dir, c+".npy"), mmap_mode='r')), _columns+[_blcode]))
+        return self
+
+    def __len__(self):
+        return self.meta['nrow'] if self.meta else 0
+
+    def __getitem__(self, col):
+        return self.cols[col]
+
+    ## Read the meta data columns from the MS and store them.
+    ## The arrays are written into a temporary directory which is
+    ## moved into place when done so an index is never half written
+    def build(self, chunksize=1000000, verbose=True):
+        parent = os.path.dirname(self.dir)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        tmp = tempfile.mkdtemp(dir=parent)
+        try:
+            with ms2util.opentable(self.msname) as tbl:
+                nrow   = len(tbl)
+                mtime  = ms2util.tableModificationTime(self.msname)
+                mkarr  = lambda (c, t): (c, numpy.lib.format.open_memmap(os.path.join(tmp, c+".npy"), mode='w+', dtype=t, shape=(nrow,)))
+                arrays = dict(map(mkarr, _columns+[_blcode]))
+                for (s, n) in ms2util.chunkert(0, nrow, chunksize, verbose=verbose):
+                    for (c, t) in _columns:
+                        arrays[c][s:s+n] = tbl.getcol(c, startrow=s, nrow=n)
+                    arrays[_blcode[0]][s:s+n] = baselineCode(arrays["ANTENNA1"][s:s+n], arrays["ANTENNA2"][s:s+n])
+                map(lambda a: a.flush(), arrays.values())
+                del arrays
+            with open(os.path.join(tmp, "meta.json"), "w") as f:
+                json.dump({'msname':self.msname, 'mtime':mtime, 'nrow':nrow}, f)
+            self.drop()
+            os.rename(tmp, self.dir)
+        except:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        return self.open()
+
+    def drop(self):
+        self.meta = None
+        self.cols = {}
+        if os.path.isdir(self.dir):
+            shutil.rmtree(self.dir)
+
+    ## Evaluate a selection. Each of the criteria may be None, meaning
+    ## "no selection on this". Returns a boolean mask for all rows
+    ##    baselines:  list of baseline codes (see baselineCode())
+    ##    fields:     list of FIELD_IDs
+    ##    timeranges: list of (start, end) tuples, inclusive
+    ##    ddids:      list of DATA_DESC_IDs
+    ##    scans:      list of (start, end, FIELD_ID, ARRAY_ID, SCAN_NUMBER) tuples
+    def mask(self, baselines=None, fields=None, timeranges=None, ddids=None, scans=None):
+        m = numpy.ones(len(self), dtype=numpy.bool)
+        for (col, vals) in [(_blcode[0], baselines), ("FIELD_ID", fields), ("DATA_DESC_ID", ddids)]:
+            if vals is not None:
+                m &= numpy.in1d(self.cols[col], vals)
+        t = self.cols["TIME"]
+        if timeranges is not None:
+            m &= reduce(lambda acc, (s, e): acc | ((t>=s) & (t<=e)), timeranges, numpy.zeros(len(self), dtype=numpy.bool))
+        if scans is not None:
+            (fld, arr, scn) = (self.cols["FIELD_ID"], self.cols["ARRAY_ID"], self.cols["SCAN_NUMBER"])
+            m &= reduce(lambda acc, (s, e, f, a, n): acc | ((t>=s) & (t<=e) & (fld==f) & (arr==a) & (scn==n)),
+                        scans, numpy.zeros(len(self), dtype=numpy.bool))
+        return m
+
+    ## Same as mask() but returns the (sorted) selected row numbers
+    def rows(self, **kwargs):
+        return numpy.flatnonzero(self.mask(**kwargs))
+
+    def __str__(self):
+        if not self.exists():
+            return "msindex: no index for {0}".format(self.msname)
+        with open(self.metaFile()) as f:
+            meta = json.load(f)
+        return "msindex: {0} index of {1} rows in {2}".format("valid" if self.valid() else "STALE", meta['nrow'], self.dir)
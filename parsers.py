@@ -1,5 +1,5 @@
 # HV: Contains parsers for querying list of scans 
-import re, hvutil, operator, math, itertools, inspect, plots, plotiterator, copy, numpy
+import re, hvutil, operator, math, itertools, inspect, plots, plotiterator, copy, numpy, collections
 
 haveQuanta = False
 try:
@@ -959,7 +959,109 @@ isect_table = {
     (False, False): shortest_apply  # only apply to first 'n' elements
 }
 
-def do_isect(d0, f, d1):
+# Apply 'f' to data sets of equal length in one go: the x, y and flag
+# arrays are stacked into 2-D arrays, 'f' is called once on those and
+# the result is split back into data sets, which share the masks.
+#   keys:      the labels of the data sets to process
+#   proto:     the data sets providing the x values and the flags
+#   yfn:       function of the stacked y values of 'proto', returns the new y values
+#   flags:     function returning the stacked flags of the new data sets
+def stack_apply(keys, proto, yfn, flags):
+    x = numpy.array(map(lambda k: proto[k]._xval.data, keys))
+    y = yfn(numpy.array(map(lambda k: proto[k]._yval.data, keys)))
+    return zip(keys, plots.plt_datasets_from_rows(x, y, flags(), all(map(lambda k: proto[k].isSorted, keys))))
+
+# the flags of data set 'ds' as an array of length 'n'
+def flags_of(ds, n):
+    return numpy.broadcast_to(ds._m_flagged, (n,))
+
+# How data sets are aligned when two of them are combined:
+#   ('none', None)        by index, as described by isect_table above
+#   ('x', tol)            by x value: each point of the left-hand data set
+#                         is combined with the nearest point of the right-hand
+#                         one if that is within 'tol'
+#   ('interpolate', tol)  by x value: the right-hand data set is linearly
+#                         interpolated at the x values of the left-hand one,
+#                         between points that are at most 'tol' apart
+# Points of the left-hand data set without counterpart are dropped.
+# A tolerance of None means "automatic": per data set half (x) or one and
+# a half times (interpolate) the smallest x step of the right-hand data set,
+# or 0 if that has only one point
+alignMethods = ['none', 'x', 'interpolate']
+defaultAlign = ('none', None)
+autoTolerance = {'x': 0.5, 'interpolate': 1.5}
+
+# Join all data sets 'keys' of d0 and d1 on their x values in one go.
+# The data sets are concatenated, each shifted by its index times a span
+# larger than the x range of all of them, such that one searchsorted()
+# finds the neighbours of all points in the data set they belong to.
+def x_join(keys, d0, f, d1, how, tol):
+    if not keys:
+        return []
+    # the data sets' x, y and flags, sorted by x. The data sets themselves
+    # are left alone; they may be stored in a variable
+    def xym(ds):
+        (x, y, m) = (ds._xval.data, ds._yval.data, numpy.broadcast_to(ds._m_flagged, ds._xval.shape))
+        if ds.isSorted:
+            return (x, y, m)
+        order = numpy.argsort(x, kind='heapsort')
+        return (x[order], y[order], m[order])
+    (xym0, xym1) = (map(lambda k: xym(d0[k]), keys), map(lambda k: xym(d1[k]), keys))
+    (n0, n1)     = (map(lambda a: len(a[0]), xym0), map(lambda a: len(a[0]), xym1))
+    (g0, g1)     = (numpy.repeat(numpy.arange(len(keys)), n0), numpy.repeat(numpy.arange(len(keys)), n1))
+    (x0, y0, m0) = map(numpy.concatenate, zip(*xym0))
+    (x1, y1, m1) = map(numpy.concatenate, zip(*xym1))
+
+    # the tolerance per data set. Data sets with only one point have no
+    # step, for those only exact matches are accepted
+    if tol is None:
+        step   = numpy.full(len(keys), numpy.inf)
+        dx     = numpy.diff(x1)
+        same   = (g1[1:]==g1[:-1]) & (dx>0)
+        numpy.minimum.at(step, g1[1:][same], dx[same])
+        tolg   = numpy.where(numpy.isfinite(step), autoTolerance[how] * step, 0)
+    else:
+        tolg   = numpy.full(len(keys), tol)
+    tol0       = tolg[g0]
+
+    # the shifted, globally sorted, x values
+    xall       = numpy.concatenate([x0, x1])
+    (lo, span) = (xall.min(), xall.max() - xall.min() + 1) if len(xall) else (0, 1)
+    (k0, k1)   = (x0 - lo + g0*span, x1 - lo + g1*span)
+
+    # indices of the left and right neighbours and whether they are
+    # in the same data set as the point. With nothing on the right-hand
+    # side we pretend there's one point, that matches nothing
+    N1         = len(k1)
+    if not N1:
+        (x1, y1, m1, g1) = (numpy.zeros(1), numpy.zeros(1), numpy.ones(1, dtype=numpy.bool), numpy.array([-1]))
+    i          = numpy.searchsorted(k1, k0, side='left' if how=='x' else 'right')
+    (jl, jr)   = (numpy.clip(i-1, 0, len(x1)-1), numpy.clip(i, 0, len(x1)-1))
+    okl        = (i>0)  & (g1[jl]==g0)
+    okr        = (i<N1) & (g1[jr]==g0)
+
+    if how=='x':
+        dl     = numpy.where(okl, x0 - x1[jl], numpy.inf)
+        dr     = numpy.where(okr, x1[jr] - x0, numpy.inf)
+        j      = numpy.where(dl<=dr, jl, jr)
+        ok     = (okl | okr) & (numpy.minimum(dl, dr) <= tol0)
+        (yr, mr) = (y1[j], m1[j])
+    else:
+        exact  = okl & (x1[jl]==x0)
+        gap    = x1[jr] - x1[jl]
+        inter  = okl & okr & ~exact & (gap<=tol0)
+        ok     = exact | inter
+        w      = numpy.where(inter, (x0 - x1[jl])/numpy.where(inter, gap, 1), 0)
+        yr     = numpy.where(inter, y1[jl] + w*(y1[jr] - y1[jl]), y1[jl])
+        mr     = m1[jl] | (inter & m1[jr])
+
+    if not numpy.all(ok):
+        print "align: {0} out of {1} points without counterpart were dropped".format(numpy.sum(~ok), len(ok))
+    sel        = numpy.flatnonzero(ok)
+    return zip(keys, plots.plt_datasets_from_segments(x0[sel], f(y0[sel], yr[sel]), m0[sel] | mr[sel],
+                                                      numpy.bincount(g0[sel], minlength=len(keys)), True))
+
+def do_isect(d0, f, d1, **env):
     # we know both d0 and d1 are flattened datasets
     # so we must iterate over the set of identical keys
     # for each key we apply the operation to the y-part of the datasets
@@ -970,6 +1072,10 @@ def do_isect(d0, f, d1):
         ds1 = d1[key]
         l0  = len(ds0._yval)
         l1  = len(ds1._yval)
+        # data sets of equal length are done in bulk, below
+        if l0==l1:
+            bylen[l0].append( key )
+            return acc
         # compare lengths (...) and decide what to do
         (msg, res) = isect_table[(l0==l1, l0==1 or l1==1)](ds0, f, ds1)
         if msg is not None:
@@ -978,23 +1084,38 @@ def do_isect(d0, f, d1):
         nOutput    = len(res[0])
         acc[ key ] = plots.plt_dataset(res[0], res[1], numpy.logical_or(ds0._m_flagged[:nOutput], ds1._m_flagged[:nOutput]))
         return acc
-    return reduce(app, set(d0.keys()) & set(d1.keys()), copy_attributes(plots.Dict(), d0))
+    keys  = list(set(d0.keys()) & set(d1.keys()))
+    (how, tol) = env.get('align', defaultAlign)
+    if how!='none':
+        rv = copy_attributes(plots.Dict(), d0)
+        rv.update( x_join(keys, d0, f, d1, how, tol) )
+        return rv
+    bylen = collections.defaultdict(list)
+    rv    = reduce(app, keys, copy_attributes(plots.Dict(), d0))
+    for (n, keys) in bylen.iteritems():
+        stacked = lambda d: numpy.array(map(lambda k: d[k]._yval.data, keys))
+        rv.update( stack_apply(keys, d0, lambda y0: f(y0, stacked(d1)),
+                               lambda: numpy.array(map(lambda k: numpy.logical_or(flags_of(d0[k], n), flags_of(d1[k], n)), keys))) )
+    return rv
 
 # implement infix operator 'f' on two datums
-def immediate_apply(l, f, r):
+def immediate_apply(l, f, r, **env):
     return f(l, r)
 
-def do_iterate(d0, f, d1):
+def do_iterate(d0, f, d1, **env):
     # we know that either d0 or d1 is a dataset
     proto    = d0 if isDataset(d0) else d1
     # from the prototype dataset 
     # apply in the correct order!
     app      = (lambda d: f(d, d1)) if isDataset(d0) else (lambda d: f(d0, d))
-    def reductor(acc, k_ds):
-        (key, ds)  = k_ds
-        acc[ key ] = plots.plt_dataset(ds._xval.data, app(ds._yval.data), ds._yval.mask)
-        return acc
-    return reduce(reductor, proto.iteritems(), copy_attributes(plots.Dict(), proto))
+    # all data sets of the same length are done in one go
+    bylen    = collections.defaultdict(list)
+    for (key, ds) in proto.iteritems():
+        bylen[ len(ds._yval) ].append( key )
+    rv       = copy_attributes(plots.Dict(), proto)
+    for (n, keys) in bylen.iteritems():
+        rv.update( stack_apply(keys, proto, app, lambda: numpy.array(map(lambda k: flags_of(proto[k], n), keys))) )
+    return rv
 
 applicator_table = { 
     # infix:  lhs <operator> rhs
@@ -1006,12 +1127,11 @@ applicator_table = {
     (True,   True): do_isect          # both are datasets, must intersect
 }
 
-def applicator(d0, f, d1):
+def applicator(d0, f, d1, **env):
     # for both arguments we want a set of keys such that we can get the intersection
     # of identical keys. But that's only if both of 'm are datasets
     # otherwise it's either just numbers that are combined or one of them is a data set
-    print "Applicator/d0=",isDataset(d0)," d1=",isDataset(d1)
-    return applicator_table[(isDataset(d0), isDataset(d1))](d0, f, d1)
+    return applicator_table[(isDataset(d0), isDataset(d1))](d0, f, d1, **env)
 
 
 def mk_dataset(ds, an):
@@ -1280,7 +1400,7 @@ def parse_dataset_expr(txt, datasets, **env):
                 raise SyntaxError, "Expected a term, got {0}".format( tok(s).value )
             def mk_f(l, o, r):
                 def do_it(ds):
-                    return applicator(l(ds), o, r(ds))
+                    return applicator(l(ds), o, r(ds), **env)
                 return do_it
             expr =  mk_f(expr, cur.value, rhs)
         return expr
@@ -1306,7 +1426,7 @@ def parse_dataset_expr(txt, datasets, **env):
 
             def mk_f(l, o, r):
                 def do_it(ds):
-                    return applicator(l(ds), o, r(ds))
+                    return applicator(l(ds), o, r(ds), **env)
                 return do_it
             term = mk_f(term, cur.value, rhs)
         return term
@@ -1330,7 +1450,7 @@ def parse_dataset_expr(txt, datasets, **env):
 
             def mk_f(e, o, f):
                 def do_it(ds):
-                    return applicator(e(ds), o, f(ds))
+                    return applicator(e(ds), o, f(ds), **env)
                 return do_it
             exponent = mk_f(exponent, cur.value, factor)
         return exponent
@@ -1345,7 +1465,7 @@ def parse_dataset_expr(txt, datasets, **env):
             exponent = parse_exponent(s)
             def mk_f(e):
                 def do_it(ds):
-                    return applicator(-1, operator.mul, e(ds))
+                    return applicator(-1, operator.mul, e(ds), **env)
                 return do_it
             exponent = mk_f(exponent)
         else:
@@ -1541,10 +1661,14 @@ def mk_regex(rx):
     return re.compile(rx[1:-1], flag)
 
 def parse_ckey_expr(expr):
+    # The names of the label attributes the colour key uses are recorded
+    # as the colour key function's 'attributes'
+    used = set()
+
     # our tokens
     tokens = [
         # the attribute names we support
-        (re.compile(r"\b(p|ch|sb|fq|bl|time|src)\b", re.I), xform_t('attrname', str.upper)),
+        (re.compile(r"\b(p|ch|sb|fq|bl|time|src)\b", re.I), xform_t('attrname', lambda a: used.add(a.upper()) or a.upper())),
         # attribute values
         #    @regex and text: we get the terminating start, end characters as well so must strip them off
         (mk_escaped_rx('/', "i?"),                          xform_t('regex', mk_regex)),
@@ -1789,7 +1913,9 @@ def parse_ckey_expr(expr):
             return "<{0}/{1}>".format(self.depth, self.token)
 
     tokenizer  = mk_tokenizer(tokens, **{})
-    return parse_ckey_expr_impl(state_type(tokenizer(expr)))
+    ckey_f     = parse_ckey_expr_impl(state_type(tokenizer(expr)))
+    ckey_f.attributes = sorted(used)
+    return ckey_f
 
 
 #########################################################################################################
@@ -1828,6 +1954,10 @@ def parse_ckey_expr(expr):
 mk_attribute_getter = lambda a: lambda obj: getattr(obj, a.upper())
 
 def parse_filter_expr(qry, **kwargs):
+    # The names of the label attributes the filter uses are recorded
+    # as the filter function's 'attributes'
+    used = set()
+
     # Helper functions
 
     def mk_intrange(txt):
@@ -1854,7 +1984,7 @@ def parse_filter_expr(qry, **kwargs):
     tokens = [
         # the attribute names we support
         #(re.compile(r"\b(p|ch|sb|fq|bl|time|src)\b", re.I), value_t('attribute')),
-        (re.compile(r"\b(p|ch|sb|fq|bl|time|src)\b", re.I), xform_t('attribute', mk_attribute_getter)),
+        (re.compile(r"\b(p|ch|sb|fq|bl|time|src)\b", re.I), xform_t('attribute', lambda a: used.add(a.upper()) or mk_attribute_getter(a))),
         # operators
         token_def(r"\bnot\b",                               operator_t('not')),
         token_def(r"\bin\b",                                operator_t('in')),
@@ -2085,7 +2215,9 @@ def parse_filter_expr(qry, **kwargs):
             return self
 
     tokenizer  = mk_tokenizer(tokens, **kwargs)
-    return parse_filter(state_type(tokenizer(qry)))
+    filter_f   = parse_filter(state_type(tokenizer(qry)))
+    filter_f.attributes = sorted(used)
+    return filter_f
 
 
 #########################################################################################################
@@ -0,0 +1,120 @@
+# Persistent, on-disk, cache of reduced data sets
+#
+# Reading + reducing the data from a (large) MS takes time. The result of
+# doing that - a dict of label => dataset - only depends on the MS contents
+# and the selection/averaging settings, so it can be stored on disk and
+# re-used the next time the exact same plots are requested, even in a
+# different session.
+#
+# Each entry is stored as a compressed numpy '.npz' file named after the
+# (hash of the) key. The x, y and mask arrays of all data sets are stored
+# concatenated, with the lengths and the labels (as JSON) stored alongside.
+# If the total size of the cache exceeds the maximum size, the least
+# recently used entries are removed.
+import os, json, hashlib, numpy, tempfile, label_v6, plotiterator, plots
+
+_attrl  = label_v6._attrl
+AX      = label_v6.AX
+YTypes  = plots.YTypes
+
+## Label values are ints, strings or None, except for the TYPE which
+## is an enumeration value
+def label2json(l):
+    return map(lambda (a, v): None if v is None else (str(v) if a is AX.TYPE else v), zip(_attrl, l))
+
+def json2label(vals):
+    def unmap( (a, v) ):
+        # JSON gives us unicode strings back
+        if type(v) is unicode:
+            v = str(v)
+        return (a, YTypes[v] if (a is AX.TYPE and v in YTypes) else v)
+    kv    = filter(lambda (a, v): v is not None, map(unmap, zip(_attrl, vals)))
+    return label_v6.label(dict(kv), map(lambda (a, v): a, kv))
+
+# numpy integers are not JSON serializable
+def json_default(o):
+    if isinstance(o, numpy.generic):
+        return o.item()
+    raise TypeError, "{0} is not JSON serializable".format( repr(o) )
+
+class plotcache(object):
+    def __init__(self, path=None, maxsize=2*1024**3):
+        self.path    = path if path else os.path.join(os.getenv('HOME'), ".jplotter.cache", "plots")
+        self.maxsize = maxsize
+        self.enabled = True
+
+    ## The key is the hash of whatever was passed in
+    def key(self, *args):
+        return hashlib.sha1( repr(args) ).hexdigest()
+
+    def fileName(self, key):
+        return os.path.join(self.path, key+".npz")
+
+    ## Return dict of label => dataset or None if not cached
+    def get(self, key):
+        if not self.enabled:
+            return None
+        fn = self.fileName(key)
+        if not os.path.isfile(fn):
+            return None
+        try:
+            with numpy.load(fn) as f:
+                labels = json.loads( str(f['labels']) )
+                (x, y, m, n) = (f['x'], f['y'], f['m'], f['n'])
+        except Exception as E:
+            print "plotcache: failed to read {0} - {1}".format(fn, E)
+            return None
+        # mark as recently used
+        os.utime(fn, None)
+        offs = numpy.cumsum(n)[:-1]
+        return dict(map(lambda (l, xs, ys, ms): (json2label(l), plotiterator.dataset(xs, ys, ms)),
+                        zip(labels, numpy.split(x, offs), numpy.split(y, offs), numpy.split(m, offs))))
+
+    ## Store dict of label => dataset
+    def put(self, key, datasets):
+        if not self.enabled:
+            return
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        items = map(lambda (l, ds): (l, ds.as_numarray()), datasets.iteritems())
+        cat   = lambda arrays, tp: numpy.concatenate(arrays) if arrays else numpy.array([], dtype=tp)
+        # write to temporary file and move into place such that
+        # readers never see a partially written file
+        (fd, tmp) = tempfile.mkstemp(dir=self.path, suffix=".npz")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                numpy.savez_compressed(f, labels=numpy.array(json.dumps(map(lambda (l, ds): label2json(l), items), default=json_default)),
+                                       x=cat(map(lambda (l, ds): ds.x, items), numpy.float64),
+                                       y=cat(map(lambda (l, ds): ds.y, items), numpy.float64),
+                                       m=cat(map(lambda (l, ds): ds.m, items), numpy.bool),
+                                       n=numpy.array(map(lambda (l, ds): len(ds.x), items), dtype=numpy.int64))
+            os.rename(tmp, self.fileName(key))
+        except:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        self.evict()
+
+    ## Remove least recently used entries until we're below the maximum size
+    def entries(self):
+        if not os.path.isdir(self.path):
+            return []
+        fns = filter(lambda fn: fn.endswith(".npz"), map(lambda fn: os.path.join(self.path, fn), os.listdir(self.path)))
+        return sorted(map(lambda fn: (os.path.getmtime(fn), os.path.getsize(fn), fn), fns))
+
+    def evict(self):
+        entries = self.entries()
+        total   = sum(map(lambda (t, sz, fn): sz, entries))
+        while entries and total>self.maxsize:
+            (t, sz, fn) = entries.pop(0)
+            os.unlink(fn)
+            total      -= sz
+
+    def clear(self):
+        map(lambda (t, sz, fn): os.unlink(fn), self.entries())
+
+    def __str__(self):
+        entries = self.entries()
+        return "plotcache: {0} in {1} [{2} entries, {3:.1f}/{4:.1f}MB]".format( \
+                "enabled" if self.enabled else "disabled", self.path, len(entries),
+                sum(map(lambda (t, sz, fn): sz, entries))/1024.0**2, self.maxsize/1024.0**2)
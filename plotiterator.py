@@ -147,7 +147,7 @@
 ##       built around ms2util.reducems
 ##
 ##
-import ms2util, hvutil, plots, jenums, itertools, copy, operator, numpy, math, imp, time, collections
+import ms2util, hvutil, plots, jenums, itertools, copy, operator, numpy, math, imp, time, collections, os, ast, weakref
 import pyrap.quanta
 
 # Auto-detect of pycasa
@@ -165,6 +165,45 @@ AX     = jenums.Axes
 AVG    = jenums.Averaging
 YTypes = plots.YTypes
 
+## By default allow the column data being read to take up this many bytes
+defaultMemory = 512 * 1024 * 1024
+
+## The most recently read complex (masked, possibly channel/time averaged)
+## visibilities, per kind of iterator:
+##     'kind' => (key, dict(label => dataset), nreject, nbytes)
+## Amplitude, phase, real and imaginary are all derived from the same complex
+## numbers so switching between e.g. 'amptime' and 'phatime' with the same
+## selection does not need to read the MS again.
+## The cached data counts against the same memory budget as the column
+## data being read; what doesn't fit isn't kept
+rawCache = {}
+
+# size of a data set's x, y and mask; these are arrays or lists of blocks/values
+def nbytes(a):
+    return a.nbytes if isinstance(a, numpy.ndarray) else \
+           (sum(map(nbytes, a)) if isinstance(a, list) else numpy.asarray(a).nbytes)
+
+def rawCacheGet(kind, key):
+    (k, pts, nreject, _) = rawCache.get(kind, (None, None, 0, 0))
+    return (pts, nreject) if (key is not None and k==key) else (None, 0)
+
+def rawCachePut(kind, key, pts=None, nreject=0, memory=defaultMemory):
+    rawCache.pop(kind, None)
+    if key is None:
+        return
+    sz = sum(map(lambda ds: nbytes(ds.x)+nbytes(ds.y)+nbytes(ds.m), pts.itervalues()))
+    if sz>memory:
+        return
+    # make room by dropping the other kinds' data
+    for k in rawCache.keys():
+        if sz+sum(map(lambda (_k, _p, _n, b): b, rawCache.itervalues()))<=memory:
+            break
+        del rawCache[k]
+    rawCache[kind] = (key, pts, nreject, sz)
+
+def rawCacheClear():
+    rawCache.clear()
+
 ## The base class holds the actual table object -
 ## makes sure the selection etc gets done
 class plotbase(object):
@@ -173,6 +212,7 @@ class plotbase(object):
     def __exit__(self, *args, **kwargs):
         if hasattr(self, 'table'):
             self.table.close()
+            del self.table
 
     # depending on combination of query or not and read flags or not
     # we have optimum call sequence for processing a table
@@ -192,18 +232,42 @@ class plotbase(object):
     def __init__(self, msname, selection, mapping, **kwargs):
         self.verbose = kwargs.setdefault('verbose', True)
         self.flags   = kwargs.get('readflags', True)
+        self.nproc   = kwargs.get('nproc', 1)
+        self.prefetch = kwargs.get('prefetch', 1)
+        self.memory   = kwargs.get('memory', defaultMemory)
+        self.mtime    = kwargs.get('mtime', None)
+        self.nreject = 0
 
         #self.table   = ms2util.opentable(msname)
-        self.table    = pycasa.table(msname) if havePyCasa else ms2util.opentable(msname)
+        opentable     = lambda: pycasa.table(msname) if havePyCasa else ms2util.opentable(msname)
+        self.table    = opentable()
         colnames      = ",".join(self.table.colnames()) + ", (FLAG_ROW || FLAG) AS FLAGCOL" if self.flags else None
 
-        ## apply selection if necessary
-        qry = selection.selectionTaQL()
-        s = NOW()
-        self.table = plotbase._qrycolmapf[(bool(qry), bool(colnames))](self.table, qry, colnames)
+        ## apply selection if necessary. If there is an index of the
+        ## meta data, the selected rows can be found from that and
+        ## we do not need to run a query for the selection
+        s     = NOW()
+        index = kwargs.get('index', None)
+        rows  = None if index is None else selection.selectionRows(index, mapping)
+        if rows is None:
+            qry   = selection.selectionTaQL()
+            qryfn = plotbase._qrycolmapf[(bool(qry), bool(colnames))]
+        else:
+            qry   = None
+            colfn = plotbase._qrycolmapf[(False, bool(colnames))]
+            if len(rows)==len(index):
+                qryfn = colfn
+            else:
+                qryfn = lambda tbl, q, c: colfn(tbl.selectrows(rows), q, c)
+        self.table = qryfn(self.table, qry, colnames)
         e = NOW()
         if qry and self.verbose:
             print "Query took\t\t{0:.3f}s".format(e-s)
+        if rows is not None and self.verbose:
+            print "Row selection took\t{0:.3f}s [{1} rows]".format(e-s, len(rows))
+        # in parallel mode each worker re-executes the query
+        # on its own table object
+        self.reopen = lambda: qryfn(opentable(), qry, colnames)
 
         ## Parse data-description-id selection into a map:
         ## self.ddSelection will be 
@@ -297,6 +361,45 @@ class plotbase(object):
     def makePlots(self, *args):
         raise RuntimeError, "Someone forgot to implement this function for this plottype"
 
+    ## The raw data read for a selection is fully determined by these;
+    ## the MS' modification time makes sure we don't use stale data
+    def rawCacheKey(self, msname, selection, mapping, *extra):
+        mtime = ms2util.tableModificationTime(msname) if self.mtime is None else self.mtime
+        return (os.path.abspath(msname), mtime, selection.selectionTaQL(),
+                str(selection.chanSel), str(selection.ddSelection), selection.solint, str(selection.timeRange),
+                selection.weightThreshold, self.flags, mapping.domain.column, str(mapping.spectralMap)) + extra
+
+    ## Compute the number of rows per chunk such that the column data of all
+    ## chunks in flight (read ahead/being processed, in all processes) fits
+    ## in the amount of memory we're allowed to use
+    def sizeChunks(self, columns, slicers):
+        inflight = self.nproc * (1 if self.prefetch<=0 else self.prefetch+2)
+        return ms2util.chunksize_for(self.table, columns, self.memory/inflight, slicers=slicers)
+
+    ## Reduce the selected table using ourselves as reduction function.
+    ## If more than one process is allowed, the reduction is done in parallel.
+    def reduceTable(self, columns, **kwargs):
+        d = {'verbose':True, 'nproc':self.nproc, 'reopen':self.reopen, 'prefetch':self.prefetch,
+             'finish':self.finishPartial, 'merge':self.mergePartial}
+        d.update( kwargs )
+        return ms2util.reducems2(self, self.table, {}, columns, **d)
+
+    ## Executed in the worker process: send back the accumulated data sets
+    ## and the number of rejected points since the previous range
+    def finishPartial(self, acc):
+        (nreject, self.nreject) = (self.nreject, 0)
+        return (acc, nreject)
+
+    ## Executed in the parent: merge the partial result into the total
+    def mergePartial(self, acc, (part, nreject)):
+        self.nreject = self.nreject + nreject
+        for (label, ds) in part.iteritems():
+            if label in acc:
+                acc[label].merge(ds)
+            else:
+                acc[label] = ds
+        return acc
+
 
 ## Unfortunately, our code relies on the fact that the numarrays returned 
 ## from "ms.getcol()" are 3-dimensional: (nintg x npol x nchannel)
@@ -328,18 +431,21 @@ def m2d(ar):
 class dataset:
     __slots__ = ['x', 'y', 'n', 'a', 'sf', 'm']
 
+    # 'ys' may be the sum of 'n' spectra; the buffers allocated
+    # by init_sumy() are integrated into in-place
     @classmethod
-    def add_sumy(self, obj, xs, ys, m):
-        obj.y = obj.y + ys
-        obj.n = obj.n + 1
-        obj.m = numpy.logical_or(obj.m, m)
+    def add_sumy(self, obj, xs, ys, m, n=1):
+        obj.y += ys
+        obj.n  = obj.n + n
+        numpy.logical_or(obj.m, m, obj.m)
 
     @classmethod
-    def init_sumy(self, obj, xs, ys, m):
+    def init_sumy(self, obj, xs, ys, m, n=1):
         obj.x  = numpy.array(xs)
         obj.y  = numpy.array(ys)
+        obj.n  = n
         obj.sf = dataset.add_sumy
-        obj.m  = m
+        obj.m  = numpy.array(m, dtype=numpy.bool)
 
     def __init__(self, x=None, y=None, m=None):
         if x is not None and len(x)!=len(y):
@@ -356,9 +462,37 @@ class dataset:
         self.y.append(yv)
         self.m.append(m)
 
+    # append a whole block of points in one go. The blocks are kept
+    # as-is and only concatenated when converting to numarray
+    def extend(self, xs, ys, m):
+        self.x.append(xs)
+        self.y.append(ys)
+        self.m.append(m)
+
     # integrate into the current buffer
-    def sumy(self, xs, ys, m):
-        self.sf(self, xs, ys, m)
+    def sumy(self, xs, ys, m, n=1):
+        self.sf(self, xs, ys, m, n)
+
+    # merge a data set that was accumulated elsewhere (e.g. by a
+    # worker process of a parallel reducems2) into this one.
+    # Data sets that were integrated into are summed, all others
+    # get the other data set's points appended
+    def merge(self, other):
+        if type(self.y) is list:
+            self.x.extend(other.x)
+            self.y.extend(other.y)
+            self.m.extend(other.m)
+        else:
+            self.sf(self, other.x, other.y, other.m, other.n)
+        return self
+
+    # the summing function cannot be pickled; it's implied by 'n'
+    def __getstate__(self):
+        return (self.x, self.y, self.n, self.a, self.m)
+
+    def __setstate__(self, state):
+        (self.x, self.y, self.n, self.a, self.m) = state
+        self.sf = dataset.add_sumy if self.n else dataset.init_sumy
 
     def average(self):
         if not self.a and self.n>1:
@@ -371,10 +505,15 @@ class dataset:
     def as_numarray(self):
         if self.is_numarray():
             return self
+        # data sets filled through ".extend()" hold a list of blocks
+        if self.x and type(self.x[0]) is numpy.ndarray:
+            self.x  = numpy.concatenate(self.x)
+            self.y  = numpy.concatenate(self.y)
+            self.m  = numpy.concatenate(self.m)
         # note to self: float32 has insufficient precision for e.g.
         # <quantity> versus time
         self.x  = numpy.array(self.x, dtype=numpy.float64)
-        self.y  = numpy.array(self.y, dtype=numpy.float64)
+        self.y  = numpy.array(self.y, dtype=numpy.complex128 if numpy.iscomplexobj(self.y) else numpy.float64)
         self.m  = numpy.array(self.m, dtype=numpy.bool)
         return self
 
@@ -384,6 +523,70 @@ class dataset:
     def __repr__(self):
         return str(self)
 
+## Accumulate data points in time bins of 'solint' length while reading.
+## Only the bins that actually received points are kept: per chunk of data
+## the unique bins with the sum and number of the unflagged points, the sum
+## of the flagged points and the total number of points. The pieces are
+## merged once enough of them were collected and at the end. The time stamps
+## are expected to be bin centres already (see 'timebin_fn').
+## as_numarray() returns a normal dataset: if no bin has more than one point
+## there's nothing to average and the points are returned with their flags,
+## otherwise the average of the unflagged points per bin; bins with only
+## flagged data are left out.
+class binned_dataset:
+    # merge the pieces when there's more than this many of them
+    maxParts = 16
+
+    def __init__(self, solint):
+        self.solint = solint
+        self.parts  = []
+
+    # bin numbers
+    def bins(self, xs):
+        return numpy.rint((xs - self.solint/2.0)/self.solint).astype(numpy.int64)
+
+    # reduce pieces (bins, sum, cnt, fsum, n) to one with unique bins
+    @staticmethod
+    def reduce(parts):
+        (b, s, c, f, n) = map(numpy.concatenate, zip(*parts))
+        (ub, inv)       = numpy.unique(b, return_inverse=True)
+        bc              = lambda w: numpy.bincount(inv, weights=w, minlength=len(ub))
+        return (ub, bc(s), bc(c).astype(numpy.int64), bc(f), bc(n).astype(numpy.int64))
+
+    def compact(self):
+        if len(self.parts)>1:
+            self.parts = [binned_dataset.reduce(self.parts)]
+        return self.parts[0] if self.parts else None
+
+    def extend(self, xs, ys, m):
+        if not len(xs):
+            return
+        m         = numpy.broadcast_to(numpy.asarray(m, dtype=numpy.bool), numpy.shape(xs))
+        (ub, inv) = numpy.unique(self.bins(xs), return_inverse=True)
+        bc        = lambda w: numpy.bincount(inv, weights=w, minlength=len(ub))
+        self.parts.append( (ub, bc(numpy.where(m, 0, ys)), bc(~m).astype(numpy.int64), bc(numpy.where(m, ys, 0)), bc(None).astype(numpy.int64)) )
+        if len(self.parts)>binned_dataset.maxParts:
+            self.compact()
+
+    def merge(self, other):
+        self.parts.extend( other.parts )
+        if len(self.parts)>binned_dataset.maxParts:
+            self.compact()
+        return self
+
+    def as_numarray(self):
+        part = self.compact()
+        if part is None:
+            return dataset(numpy.array([]), numpy.array([]), numpy.array([], dtype=numpy.bool))
+        (b, s, c, f, n) = part
+        x = b*self.solint + self.solint/2.0
+        # nothing to average: keep the points and their flags
+        if numpy.all(n<=1):
+            return dataset(x, s + f, c==0)
+        nz = numpy.flatnonzero(c)
+        return dataset(x[nz], s[nz]/c[nz], numpy.zeros(len(nz), dtype=numpy.bool))
+
+
 ## Partition a data set into two separate data sets,
 ## one with those elements satisfying the predicate,
 ## the other those who dont.
@@ -416,19 +619,75 @@ class partitioner:
                 'dyn-mark-string', 'exec')
         self.mod  = imp.new_module("dyn_marker_mod")
         exec self.code in self.mod.__dict__
+        # The same expression, but evaluated on whole arrays at once. In here
+        # numpy's functions take precedence over math's and the boolean
+        # operators are replaced by their numpy equivalents
+        self.vmod = imp.new_module("dyn_vmarker_mod")
+        exec "from math  import *\nfrom numpy import *\n" in self.vmod.__dict__
+        self.vmod.f = eval(compile(vectorize_expr(expr), 'dyn-vmark-string', 'eval'), self.vmod.__dict__)
+        # cache of results per data set: (id(x), id(y)) => (ref(x), ref(y), indices)
+        self.cache = {}
 
     def __call__(self, x, y):
-        ds_true       = []
-        self.mod.avg  = numpy.mean(y)
-        self.mod.sd   = numpy.std(y)
-        self.mod.xmin = numpy.min(x)
-        self.mod.xmax = numpy.max(x)
-        self.mod.ymin = numpy.min(y)
-        self.mod.ymax = numpy.max(y)
-        for i in xrange(len(x)):
-            if self.mod.f(x[i], y[i]):
-                ds_true.append(i)
-        return ds_true
+        key = (id(x), id(y))
+        hit = self.cache.get(key, None)
+        if hit is not None and hit[0]() is x and hit[1]() is y:
+            return hit[2]
+        rv = self.evaluate(x, y)
+        try:
+            forget = lambda ref, key=key: self.cache.pop(key, None)
+            self.cache[key] = (weakref.ref(x, forget), weakref.ref(y, forget), rv)
+        except TypeError:
+            # not an array - cannot be cached
+            pass
+        return rv
+
+    # returns the indices of the points satisfying the expression
+    def evaluate(self, x, y):
+        stats = dict(avg=numpy.mean(y), sd=numpy.std(y), xmin=numpy.min(x), xmax=numpy.max(x), ymin=numpy.min(y), ymax=numpy.max(y))
+        self.vmod.__dict__.update( stats )
+        try:
+            r = numpy.asarray(self.vmod.f(numpy.asarray(x), numpy.asarray(y)))
+            if r.shape==():
+                return numpy.arange(len(x)) if r else numpy.array([], dtype=numpy.int64)
+            if r.shape==(len(x),):
+                return numpy.flatnonzero(r)
+        except Exception:
+            pass
+        # Expression cannot be evaluated on arrays, do it point by point
+        self.mod.__dict__.update( stats )
+        f = self.mod.f
+        return numpy.array(filter(lambda i: f(x[i], y[i]), xrange(len(x))), dtype=numpy.int64)
+
+## Rewrite the boolean operators in an expression such that it can be evaluated
+## on whole arrays: 'a and b' => logical_and(a, b), 'not a' => logical_not(a) and
+## 'a < b < c' => logical_and(a < b, b < c). Returns an AST of 'lambda x, y: <expr>'
+class vectorizer(ast.NodeTransformer):
+    def call(self, fn, args, node):
+        return ast.copy_location(ast.Call(func=ast.Name(id=fn, ctx=ast.Load()), args=args, keywords=[], starargs=None, kwargs=None), node)
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        fn = 'logical_and' if isinstance(node.op, ast.And) else 'logical_or'
+        return reduce(lambda acc, v: self.call(fn, [acc, v], node), node.values[1:], node.values[0])
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        return self.call('logical_not', [node.operand], node) if isinstance(node.op, ast.Not) else node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops)==1:
+            return node
+        operands = [node.left] + node.comparators
+        cmps     = map(lambda (l, op, r): ast.copy_location(ast.Compare(left=l, ops=[op], comparators=[r]), node),
+                       zip(operands[:-1], node.ops, operands[1:]))
+        return reduce(lambda acc, c: self.call('logical_and', [acc, c], node), cmps[1:], cmps[0])
+
+def vectorize_expr(expr):
+    body = vectorizer().visit( ast.parse(expr.strip(), mode='eval').body )
+    args = ast.arguments(args=[ast.Name(id='x', ctx=ast.Param()), ast.Name(id='y', ctx=ast.Param())], vararg=None, kwarg=None, defaults=[])
+    return ast.fix_missing_locations( ast.Expression(body=ast.Lambda(args=args, body=body)) )
 
 
 ## Turn an array of channel indices (the channels that we're interested in)
@@ -453,6 +712,29 @@ def mk3dmask_fn_mask(nrow, chanidx, npol):
         return lambda x: numpy.ma.MaskedArray(x, mask=numpy.ma.nomask)
 
 
+## Group the rows of a chunk of data by the values found in the columns
+## passed in (e.g. ANTENNA1, ANTENNA2, DATA_DESC_ID, FIELD_ID).
+## Returns a list of index arrays, one per unique combination of values.
+## Inside each group the original row order is preserved (lexsort is stable)
+## such that data points keep being appended in time order.
+def group_rows(*cols):
+    (order, starts) = sort_rows(*cols)
+    return numpy.split(order, starts[1:]) if len(order) else []
+
+## sort_rows() returns the row order and the start index of each group
+## in that order; suitable for feeding to numpy.<ufunc>.reduceat()
+def sort_rows(*cols):
+    order = numpy.lexsort(cols)
+    if not len(order):
+        return (order, order)
+    chg    = numpy.zeros(len(order), dtype=numpy.bool)
+    chg[0] = True
+    for c in cols:
+        sc       = c[order]
+        chg[1:] |= (sc[1:]!=sc[:-1])
+    return (order, numpy.flatnonzero(chg))
+
+
 def genrows(bls, ddids, fldids):
     tm = 0
     while True:
@@ -537,9 +819,6 @@ class fakems:
 
 #### Different solint functions
 
-def solint_none(dsref):
-    return 0.0
-
 # Tried a few different approaches for solint processing.
 # The functions below are kept as illustrative references.
 # 
@@ -551,6 +830,8 @@ def solint_none(dsref):
 #  solint_pure_python:          3.8s
 #  solint_pure_python3:         3.2s
 #  solint_pure_python2:         2.8s
+#
+# Nowadays the binning is done while reading the data, see binned_dataset.
 
 
 def solint_numpy_indexing(dsref):
@@ -674,31 +955,6 @@ def solint_pure_python2(dsref):
     dsref.y = y
     return time.time() - start
 
-def solint_pure_python2a(dsref):
-    start = time.time()
-    tms   = set(dsref.x)
-
-    # check if there is something to be averaged at all
-    if len(tms)==len(dsref.x):
-        return time.time() - start
-
-    # accumulate data into bins of the same time
-    acc = collections.defaultdict(list)
-    y   = dsref.y
-    m   = dsref.m
-    for (i, tm) in enumerate(dsref.x):
-        if m[i] == False:
-            acc[ tm ].append( y[i] )
-    # do the averaging
-    (xl, yl) = (list(), list())
-    for (tm, ys) in acc.iteritems():
-        xl.append(tm)
-        yl.append( sum(ys)/len(ys) )
-    dsref.x = xl
-    dsref.y = yl
-    dsref.m = numpy.zeros(len(xl), dtype=numpy.bool)
-    return time.time() - start
-
 # In solint_pure_python4 we do not check IF we need to do something, just DO it
 def solint_pure_python4(dsref):
     start = time.time()
@@ -752,18 +1008,17 @@ class data_quantity_time(plotbase):
         #   Vector => compute average cplx number, then the quantity
         avgChannel = CP(selection.averageChannel)
 
-        # Support "time averaging" by aggregating data points in time bins of 'solint' length
+        # Support "time averaging" by aggregating data points in time bins of 'solint' length.
+        # The binning is done while reading: only the sums and counts per bin are kept
         solint          = CP(selection.solint)
-        solint_fn       = solint_none
         self.timebin_fn = lambda x: x 
+        self.mkds       = dataset
         if not (solint is None):
             ti = mapping.timeRange.inttm[0]
             if solint<ti: 
                 raise RuntimeError, "solint value {0:.3f} is less than integration time {1:.3f}".format(solint, ti)
             self.timebin_fn = lambda x: (numpy.trunc(x/solint)*solint) + solint/2.0
-
-            # decide which solint function to use
-            solint_fn = solint_pure_python2a
+            self.mkds       = lambda: binned_dataset(solint)
 
         if selection.averageTime!=AVG.None:
             print "Warning: {0} time averaging ignored for this plot".format(selection.averageTime)
@@ -787,9 +1042,7 @@ class data_quantity_time(plotbase):
         #    also allows us to create a slicer
         #    default: iterate over all channels
         shape           = self.table[0][datacol].shape
-        self.chunksize  = 5000
         self.chanidx    = zip(range(shape[0]), range(shape[0]))
-        self.maskfn     = lambda x: numpy.ma.MaskedArray(x, mask=numpy.ma.nomask)
         self.chansel    = range(shape[0])
 
         # After having read the data, first we apply the masking function
@@ -800,7 +1053,6 @@ class data_quantity_time(plotbase):
             self.chanidx     = zip(indices, channels)
             self.chansel     = indices
             #print "channels=",channels," indices=",indices," self.chanidx=",self.chanidx
-            self.maskfn      = mk3dmask_fn_mask(self.chunksize, indices, shape[-1])
             slicers[datacol] = ms2util.mk_slicer((channels[0],  0), (channels[-1]+1, shape[-1]))
 
         # If there is vector averaging to be done, this is done in the step after reading the data
@@ -821,8 +1073,17 @@ class data_quantity_time(plotbase):
 
         fields = [AX.TYPE, AX.BL, AX.FQ, AX.SB, AX.SRC, AX.P, AX.CH]
 
+        # Unless the quantities must be computed before averaging over the
+        # channels, we collect the complex numbers and derive the quantities
+        # afterwards. The complex data can then be re-used for any other
+        # quantity versus time with the same selection.
+        # With solint the quantities are binned in time while reading
+        # so we cannot keep the complex data
+        rawKey     = None if (avgChannel==AVG.Scalar or solint) else self.rawCacheKey(msname, selection, mapping, str(avgChannel))
+        self.qlist = self.quantities if rawKey is None else [('raw', lambda x: x)]
+        (pts, self.nreject) = rawCacheGet('time', rawKey)
+
         # weight filtering
-        self.nreject   = 0
         self.reject_f  = lambda weight: False
         self.threshold = -10000000
         if selection.weightThreshold is not None:
@@ -839,20 +1100,37 @@ class data_quantity_time(plotbase):
             self.actual_fn = self.withWeightOneLabel
         if self.flags:
             columns.append( "FLAGCOL" )
-        pts =  ms2util.reducems2(self, self.table, {}, columns, verbose=True, slicers=slicers, chunksize=self.chunksize)
+        if pts is None:
+            # release the stale data before reading anew
+            rawCachePut('time', None)
+            # size the chunks after the amount of memory we may use and
+            # create the channel selection mask for chunks of that size
+            self.chunksize = self.sizeChunks(columns, slicers)
+            self.maskfn    = mk3dmask_fn_mask(self.chunksize, self.chansel, shape[-1])
+            pts =  self.reduceTable(columns, slicers=slicers, chunksize=self.chunksize)
+            # the data was accumulated in blocks (or bins), glue them together
+            pts = dict(map(lambda (l, ds): (l, ds.as_numarray()), pts.iteritems()))
+            rawCachePut('time', rawKey, pts, self.nreject, self.memory)
+        elif self.verbose:
+            print "Re-using {0} data sets of complex data read before".format( len(pts) )
 
         if self.nreject:
             print "Rejected ",self.nreject," points because of weight criterion"
 
         rv  = {}
-        dt  = 0.0
-        for (label, dataset) in pts.iteritems():
-            # do time averaging - find all data points with the same x-value and scalar average them
-            # [the time stamps have been changed into integer multiples of solint, if solint!=None]
-            dt += solint_fn( dataset )
-            rv[ self.MKLAB(fields, label) ] = dataset
-        if solint:
-            print "SOLINT processing took\t{0:.3f}s".format( dt )
+        for (label, ds) in pts.iteritems():
+            if rawKey is None:
+                dsl = [(label, ds)]
+            else:
+                # derive the quantities from the (cached) complex numbers;
+                # leave the cached data set untouched
+                dl  = list(label)
+                dsl = []
+                for (qnm, qfn) in self.quantities:
+                    dl[0] = qnm
+                    dsl.append( (tuple(dl), dataset(ds.x, numpy.ma.getdata(qfn(ds.y)), numpy.array(ds.m))) )
+            for (l, d) in dsl:
+                rv[ self.MKLAB(fields, l) ] = d
         #for k in rv.keys():
         #    print "Plot:",str(k),"/",map(str, rv[k].keys())
         #for plt in rv.keys():
@@ -883,28 +1161,40 @@ class data_quantity_time(plotbase):
         # Now create the quantity data - map the quantity functions over the
         # (potentially) vector averaged data and (potentially) scalar
         # average them
-        qd   = map(lambda (qnm, qfn): (qnm, self.scalarAvg(qfn(vamd))), self.quantities)
+        qd   = map(lambda (qnm, qfn): (qnm, numpy.ma.getdata(self.scalarAvg(qfn(vamd)))), self.qlist)
 
         # Transform the time stamps [rounds time to integer multiples of solint, if that is set]
         tm   = self.timebin_fn( tm )
         flag = flag[0] if flag else None
-        flg  = (lambda row, ch, p: False) if flag is None else (lambda row, ch, p: flag[row, ch, p])
+        flg  = (lambda idx, ch, p: numpy.zeros(len(idx), dtype=numpy.bool)) if flag is None else (lambda idx, ch, p: flag[idx, ch, p])
 
-        # Now we can loop over all the rows in the data
+        # In stead of looping over all the rows in the data, group the rows
+        # by baseline, data description id and source. For each group the
+        # data for all rows is appended to the data sets in one go.
 
         # We don't have to test *IF* the current data description id is 
         # selected; the fact that we see it here means that it WAS selected!
         # The only interesting bit is selecting the correct products
-        for row in range(shp[0]):
+        for idx in group_rows(a1, a2, dd, fld):
+            row             = idx[0]
             (fq, sb, plist) = self.ddSelection[ dd[row] ]
+            tms             = tm[idx]
             for (chi, chn) in self.chanidx:
                 for (pidx, pname) in plist:
                     l = ["", (a1[row], a2[row]), fq, sb, fld[row], pname, chn]
+                    f = flg(idx, chi, pidx)
                     for (qnm, qval) in qd:
                         l[0] = qnm
-                        acc.setdefault(tuple(l), dataset()).append(tm[row], qval[row, chi, pidx], flg(row, chi, pidx))
+                        self.accumulator(acc, tuple(l)).extend(tms, qval[idx, chi, pidx], f)
         return acc
 
+    # the data set to accumulate label 'l' in
+    def accumulator(self, acc, l):
+        ds = acc.get(l, None)
+        if ds is None:
+            ds = acc[l] = self.mkds()
+        return ds
+
     #### This is the version WITH WEIGHT THRESHOLDING
     def withWeightOneLabel(self, acc, a1, a2, tm, dd, fld, weight, data, *flag):
         #print "__call__: ",a1,a2,tm,dd,fld,data.shape
@@ -913,13 +1203,11 @@ class data_quantity_time(plotbase):
         shp  = data.shape
 
         # compute weight mask
-        w3d  = numpy.zeros(shp, dtype=numpy.float)
-        for i in xrange(shp[0]):
-            # we have weights per polzarization but we must
-            # expand them to per channel ...
-            cw = numpy.vstack( shp[1]*[weight[i]] )
-            w3d[i] = cw
-        w3m =  w3d<self.threshold
+        # we have weights per polzarization but we must
+        # expand them to per channel ...
+        w2d  = weight.reshape( (d3d.shape[0], -1) )
+        w3d  = numpy.repeat(w2d[:, numpy.newaxis, :], d3d.shape[1], axis=1)
+        w3m  = w3d<self.threshold
         wfn = lambda a: numpy.ma.MaskedArray(a.data, numpy.logical_and(a.mask, w3m))
         # Good. We have a block of data, shape (nrow, nchan, npol)
         # Step 1: apply the masking + vector averaging
@@ -933,34 +1221,39 @@ class data_quantity_time(plotbase):
         # Now create the quantity data - map the quantity functions over the
         # (potentially) vector averaged data and (potentially) scalar
         # average them
-        qd   = map(lambda (qnm, qfn): (qnm, self.scalarAvg(qfn(vamd))), self.quantities)
+        qd   = map(lambda (qnm, qfn): (qnm, numpy.ma.getdata(self.scalarAvg(qfn(vamd)))), self.qlist)
         #for (qn, qv) in qd:
         #    print qn,": shape=",qv.shape
 
         # Transform the time stamps [rounds time to integer multiples of solint, if that is set]
         tm   = self.timebin_fn( tm )
         flag = flag[0] if flag else None
-        flg  = (lambda row, ch, p: False) if flag is None else (lambda row, ch, p: flag[row, ch, p])
+        flg  = (lambda idx, ch, p: numpy.zeros(len(idx), dtype=numpy.bool)) if flag is None else (lambda idx, ch, p: flag[idx, ch, p])
 
-        # Now we can loop over all the rows in the data
+        # Group the rows by baseline, data description id and source
+        # and append all data for each group in one go
 
         # We don't have to test *IF* the current data description id is 
         # selected; the fact that we see it here means that it WAS selected!
         # The only interesting bit is selecting the correct products
-        for row in range(shp[0]):
+        for idx in group_rows(a1, a2, dd, fld):
+            row             = idx[0]
             (fq, sb, plist) = self.ddSelection[ dd[row] ]
             for (chi, chn) in self.chanidx:
                 for (pidx, pname) in plist:
-                    if self.reject_f(w3d[row, chi, pidx]):
-                        self.nreject = self.nreject + 1
+                    # the weights are per polarization so the same for all channels
+                    keep = numpy.logical_not(self.reject_f(w2d[idx, pidx]))
+                    nok  = numpy.sum(keep)
+                    self.nreject = self.nreject + (len(idx) - nok)
+                    if not nok:
                         continue
-                    l = ["", (a1[row], a2[row]), fq, sb, fld[row], pname, chn]
+                    ridx = idx[keep]
+                    tms  = tm[ridx]
+                    f    = flg(ridx, chi, pidx)
+                    l    = ["", (a1[row], a2[row]), fq, sb, fld[row], pname, chn]
                     for (qnm, qval) in qd:
                         l[0] = qnm
-                        #pi       = self.plot_idx(l)
-                        #di       = self.ds_idx(l)
-                        #print "row #",row,"/l=",l," => pi=",pi," di=",di," qval.shape=",qval.shape
-                        acc.setdefault(tuple(l), dataset()).append(tm[row], qval[row, chi, pidx], flg(row, chi, pidx))
+                        self.accumulator(acc, tuple(l)).extend(tms, qval[ridx, chi, pidx], f)
         return acc
 
 ## This plotter will iterate over "DATA" or "LAG_DATA"
@@ -1030,8 +1323,6 @@ class data_quantity_chan(plotbase):
         #    also allows us to create a slicer
         #    default: iterate over all channels
         shape           = self.table[0][datacol].shape
-        self.chunksize  = 5000
-        self.maskfn     = lambda x: numpy.ma.MaskedArray(x, mask=numpy.ma.nomask)
         self.chanidx    = numpy.arange(shape[0])
         self.chansel    = numpy.arange(shape[0])
 
@@ -1042,7 +1333,6 @@ class data_quantity_chan(plotbase):
             indices          = map(lambda x: x-channels[0], channels)
             self.chanidx     = numpy.array(channels, dtype=numpy.int32)
             self.chansel     = numpy.array(indices, dtype=numpy.int32)
-            self.maskfn      = mk3dmask_fn_mask(self.chunksize, indices, shape[-1])
             slicers[datacol] = ms2util.mk_slicer((channels[0],  0), (channels[-1]+1, shape[-1]))
 
         # This is how we're going to go about dealing with time averaging
@@ -1087,18 +1377,23 @@ class data_quantity_chan(plotbase):
                 # we have already checked the validity of solint
                 self.timebin_fn = lambda x: (numpy.trunc(x/solint)*solint) + solint/2.0
 
-        # With no time averaging or with Scalar averaging, we can immediately produce
-        # the quantities. Only when doing Vector averaging, we must produce the quantities
+        # With Scalar averaging, we can immediately produce the quantities.
+        # When doing Vector averaging, we must produce the quantities
         # after having read all the data
         self.preProcess = lambda x: map(lambda (qnm, qfn): (qnm, qfn(x)), self.quantities)
         if avgTime in [AVG.Vector, AVG.Vectornorm]:
             doNormalize     = (lambda x: x) if avgTime==AVG.Vector else (lambda x: x/numpy.abs(x))
             self.preProcess = lambda x: [('raw', doNormalize(x))]
+        # Without averaging we also keep the complex numbers such that the
+        # read data can be re-used for any quantity with the same selection
+        if avgTime==AVG.None:
+            self.preProcess = lambda x: [('raw', x)]
+        rawKey = None if avgTime==AVG.Scalar else self.rawCacheKey(msname, selection, mapping, str(avgTime), self.byFrequency)
+        (pts, self.nreject) = rawCacheGet('chan', rawKey)
 
         fields = [AX.TYPE, AX.BL, AX.FQ, AX.SB, AX.SRC, AX.P, AX.TIME]
 
         # weight filtering
-        self.nreject   = 0
         self.reject_f  = lambda weight: False
         self.threshold = -10000000
         if not selection.weightThreshold is None:
@@ -1114,12 +1409,24 @@ class data_quantity_chan(plotbase):
             self.actual_fn = self.withWeightThresholding
         if self.flags:
             columns.append( "FLAGCOL" )
-        pts     =  ms2util.reducems2(self, self.table, {}, columns, verbose=True, slicers=slicers, chunksize=self.chunksize)
+        if pts is None:
+            # release the stale data before reading anew
+            rawCachePut('chan', None)
+            # size the chunks after the amount of memory we may use and
+            # create the channel selection mask for chunks of that size
+            self.chunksize = self.sizeChunks(columns, slicers)
+            self.maskfn    = mk3dmask_fn_mask(self.chunksize, self.chansel, shape[-1])
+            pts     =  self.reduceTable(columns, slicers=slicers, chunksize=self.chunksize)
+            rawCachePut('chan', rawKey, pts, self.nreject, self.memory)
+        elif self.verbose:
+            print "Re-using {0} data sets of complex data read before".format( len(pts) )
 
         if self.nreject:
             print "Rejected ",self.nreject," points because of weight criterion"
 
         ## Excellent. Now start post-processing
+        ## (averaging a data set more than once is a no-op, which
+        ##  is important for the cached raw data sets)
         rv  = {}
         for (label, ds) in pts.iteritems():
             ds.average()
@@ -1127,7 +1434,7 @@ class data_quantity_chan(plotbase):
                 dl = list(label)
                 for (qnm, qd) in map(lambda (qnm, qfn): (qnm, qfn(ds.y)), self.quantities):
                     dl[0] = qnm
-                    rv[ self.MKLAB(fields, dl) ] = dataset(ds.x, qd, ds.m)
+                    rv[ self.MKLAB(fields, dl) ] = dataset(ds.x, qd, numpy.array(ds.m))
             else:
                 rv[ self.MKLAB(fields, label) ] = ds
         #for k in rv.keys():
@@ -1163,41 +1470,20 @@ class data_quantity_chan(plotbase):
         # if that is set or the midpoint of the time range if solint was None]
         tm   = self.timebin_fn( tm )
         flag = flag[0] if flag else numpy.zeros(data.shape, dtype=numpy.bool)
-
-        # Now we can loop over all the rows in the data
-
-        # We don't have to test *IF* the current data description id is 
-        # selected; the fact that we see it here means that it WAS selected!
-        # The only interesting bit is selecting the correct products
-        for row in range(shp[0]):
-            ddr             = dd[row]
-            (fq, sb, plist) = self.ddSelection[ ddr ]
-            # we can already precompute most of the label
-            # potentially, modify the TIME value to be a time bucket such
-            # that we can intgrate into it
-            l = ["", (a1[row], a2[row]), fq, sb, fld[row], "", tm[row]]
-            # we don't iterate over channels, only over polarizations
-            for (pidx, pname) in plist:
-                l[5] = pname
-                for (qnm, qval) in qd:
-                    l[0] = qnm
-                    acc.setdefault(tuple(l), dataset()).sumy(self.changeXaxis(ddr, self.chanidx), qval[row, self.chansel, pidx], flag[row, self.chansel, pidx])
-        return acc
+        return self.accumulate(acc, a1, a2, tm, dd, fld, qd, flag, None)
 
     # This is the one WITH WEIGHT THRESHOLDING
-    def withWeightThresholding(self, acc, a1, a2, tm, dd, fld, weight, data):
+    def withWeightThresholding(self, acc, a1, a2, tm, dd, fld, weight, data, *flag):
         # Make really sure we have a 3-D array of data ...
         d3d  = m3d(data)
         shp  = data.shape
 
         # compute weight mask
-        w3d  = numpy.zeros(shp, dtype=numpy.float)
-        for i in xrange(shp[0]):
-            # we have weights per polzarization but we must
-            # expand them to per channel ...
-            cw = numpy.vstack( shp[1]*[weight[i]] )
-            w3d[i] = cw
-        w3m =  w3d<self.threshold
+        # we have weights per polzarization but we must
+        # expand them to per channel ...
+        w2d  = weight.reshape( (d3d.shape[0], -1) )
+        w3d  = numpy.repeat(w2d[:, numpy.newaxis, :], d3d.shape[1], axis=1)
+        w3m  = w3d<self.threshold
         wfn = lambda a: numpy.ma.MaskedArray(a.data, numpy.logical_and(a.mask, w3m))
 
         # Good. We have a block of data, shape (nrow, nchan, npol)
@@ -1219,27 +1505,56 @@ class data_quantity_chan(plotbase):
         tm   = self.timebin_fn( tm )
         flag = flag[0] if flag else numpy.zeros(data.shape, dtype=numpy.bool)
 
-        # Now we can loop over all the rows in the data
+        # the weights are per polarization; (row, pol) combinations
+        # with a weight below the threshold do not contribute
+        keep = numpy.logical_not(self.reject_f(w2d))
+        self.nreject = self.nreject + (keep.size - numpy.sum(keep))
+        return self.accumulate(acc, a1, a2, tm, dd, fld, qd, flag, keep)
+
+    # Integrate a chunk of rows into the data sets.
+    # In stead of looping over all the rows in the data, the rows are sorted
+    # into slots of (baseline, data description id, source, time bin) and
+    # the spectra for each slot are summed in one go using reduceat().
+    # 'keep' is None or a (nrow, npol) boolean array of rows to integrate
+    def accumulate(self, acc, a1, a2, tm, dd, fld, qd, flag, keep):
+        (order, starts) = sort_rows(a1, a2, dd, fld, tm)
+        if not len(order):
+            return acc
+        chsel = self.chansel
+        qd    = map(lambda (qnm, qval): (qnm, numpy.ma.getdata(qval)[order][:, chsel, :]), qd)
+        flag  = flag[order][:, chsel, :]
+        if keep is None:
+            cnt  = numpy.repeat(numpy.diff(numpy.append(starts, len(order)))[:, numpy.newaxis], flag.shape[2], axis=1)
+            sums = map(lambda (qnm, qval): (qnm, numpy.add.reduceat(qval, starts, axis=0)), qd)
+        else:
+            keep = keep[order]
+            k3d  = keep[:, numpy.newaxis, :]
+            cnt  = numpy.add.reduceat(keep.astype(numpy.int32), starts, axis=0)
+            flag = numpy.logical_and(flag, k3d)
+            sums = map(lambda (qnm, qval): (qnm, numpy.add.reduceat(numpy.where(k3d, qval, 0), starts, axis=0)), qd)
+        flag = numpy.logical_or.reduceat(flag, starts, axis=0)
 
         # We don't have to test *IF* the current data description id is 
         # selected; the fact that we see it here means that it WAS selected!
         # The only interesting bit is selecting the correct products
-        for row in range(shp[0]):
+        for (slot, first) in enumerate(starts):
+            row             = order[first]
             ddr             = dd[row]
             (fq, sb, plist) = self.ddSelection[ ddr ]
+            xs              = self.changeXaxis(ddr, self.chanidx)
             # we can already precompute most of the label
             # potentially, modify the TIME value to be a time bucket such
             # that we can intgrate into it
             l = ["", (a1[row], a2[row]), fq, sb, fld[row], "", tm[row]]
             # we don't iterate over channels, only over polarizations
             for (pidx, pname) in plist:
-                if self.reject_f(w3d[row, 0, pidx]):
-                    self.nreject = self.nreject + 1
+                n = cnt[slot, pidx]
+                if not n:
                     continue
                 l[5] = pname
-                for (qnm, qval) in qd:
+                for (qnm, qsum) in sums:
                     l[0] = qnm
-                    acc.setdefault(tuple(l), dataset()).sumy(self.changeXaxis(ddr, self.chanidx), qval[row, self.chansel, pidx], flag[row, self.chansel, pidx])
+                    acc.setdefault(tuple(l), dataset()).sumy(xs, qsum[slot, :, pidx], flag[slot, :, pidx], n)
         return acc
 
 
@@ -1263,8 +1578,8 @@ class weight_time(plotbase):
         #self.cnt = 0
         #self.ts  = set()
         ## Now we can start the reduction of the table
-        columns = ["ANTENNA1", "ANTENNA2", "TIME", "DATA_DESC_ID", "FIELD_ID", "WEIGHT"] + ["FLAG_ROW"] if self.flags else []
-        pts     =  ms2util.reducems2(self, self.table, {}, columns, verbose=True, chunksize=5000)
+        columns = ["ANTENNA1", "ANTENNA2", "TIME", "DATA_DESC_ID", "FIELD_ID", "WEIGHT"] + (["FLAG_ROW"] if self.flags else [])
+        pts     =  self.reduceTable(columns, chunksize=self.sizeChunks(columns, {}))
 
         #print "WE SHOULD HAVE ",self.cnt," DATA POINTS"
         #print "ANDALSO ",len(self.ts)," TIME STAMPS"
@@ -1306,8 +1621,8 @@ class uv(plotbase):
         fields = [AX.TYPE, AX.BL, AX.FQ, AX.SB, AX.SRC]
 
         ## Now we can start the reduction of the table
-        columns = ["ANTENNA1", "ANTENNA2", "DATA_DESC_ID", "FIELD_ID", "UVW"] + ["FLAG_ROW"] if self.flags else []
-        pts     =  ms2util.reducems2(self, self.table, {}, columns, verbose=True, chunksize=5000)
+        columns = ["ANTENNA1", "ANTENNA2", "DATA_DESC_ID", "FIELD_ID", "UVW"] + (["FLAG_ROW"] if self.flags else [])
+        pts     =  self.reduceTable(columns, chunksize=self.sizeChunks(columns, {}))
 
         rv  = {}
         for (label, dataset) in pts.iteritems():
@@ -1370,9 +1685,7 @@ class data_quantity_uvdist(plotbase):
         #    also allows us to create a slicer
         #    default: iterate over all channels
         shape           = self.table[0][datacol].shape
-        self.chunksize  = 5000
         self.chanidx    = zip(range(shape[0]), range(shape[0]))
-        self.maskfn     = lambda x: numpy.ma.MaskedArray(x, mask=numpy.ma.nomask)
         self.chansel    = range(shape[0])
 
         # We must translate the selected channels to a frequency (or wavelength) - such that we can 
@@ -1397,7 +1710,6 @@ class data_quantity_uvdist(plotbase):
             # select only the selected channels
             self.factors     = self.factors[:, channels]
             #print "channels=",channels," indices=",indices," self.chanidx=",self.chanidx
-            self.maskfn      = mk3dmask_fn_mask(self.chunksize, indices, shape[-1])
             slicers[datacol] = ms2util.mk_slicer((channels[0],  0), (channels[-1]+1, shape[-1]))
 
         # right - factors now contain *frequency*
@@ -1446,7 +1758,11 @@ class data_quantity_uvdist(plotbase):
             self.actual_fn = self.withWeightThresholding
         if self.flags:
             columns.append( "FLAGCOL" )
-        pts =  ms2util.reducems2(self, self.table, {}, columns, verbose=True, slicers=slicers, chunksize=self.chunksize)
+        # size the chunks after the amount of memory we may use and
+        # create the channel selection mask for chunks of that size
+        self.chunksize = self.sizeChunks(columns, slicers)
+        self.maskfn    = mk3dmask_fn_mask(self.chunksize, self.chansel, shape[-1])
+        pts =  self.reduceTable(columns, slicers=slicers, chunksize=self.chunksize)
 
         if self.nreject:
             print "Rejected ",self.nreject," points because of weight criterion"
@@ -1,5 +1,5 @@
 # the possible plottypes are defined here,
-import enumerations, jenums, ms2util, hvutil, parsers, copy, re, inspect, math, numpy, operator, os, types, functional
+import enumerations, jenums, ms2util, hvutil, parsers, copy, re, inspect, math, numpy, operator, os, types, functional, collections, itertools, label_v6
 from label_v6   import label
 
 AX       = jenums.Axes
@@ -34,6 +34,34 @@ class pgenv(object):
         self.plotter.pgunsa()
 
 
+## Record the PGPLOT calls made while drawing such that the drawing can be
+## repeated ("replayed") without redoing any of the work that went into it.
+## Use it in place of the device. Queries are passed on to the device but
+## not recorded; their outcome is already reflected in the recorded calls.
+class pgrecorder(object):
+    queries = re.compile(r"^pg(q\w+|len)$")
+
+    def __init__(self, device):
+        self.device = device
+        self.calls  = []
+        # approximate amount of memory held by the recorded calls
+        self.nbytes = 0
+
+    def __getattr__(self, fn):
+        f = getattr(self.device, fn)
+        if pgrecorder.queries.match(fn):
+            return f
+        def record(*args):
+            self.calls.append( (f, args) )
+            self.nbytes += 64 + sum(map(lambda a: a.nbytes if isinstance(a, numpy.ndarray) else 8, args))
+            return f(*args)
+        return record
+
+    def replay(self):
+        for (f, args) in self.calls:
+            f(*args)
+
+
 ## Keep track of the layout of a page in number-of-plots in X,Y direction
 class layout(object):
     def __init__(self, nx, ny):
@@ -47,6 +75,54 @@ class layout(object):
         return "{2} plots organized as {0} x {1}".format(self.nx, self.ny, self.nplots())
 
 
+## Level-of-detail reduction: there is no point in sending more points to
+## PGPLOT than the current viewport can resolve. The viewport (as set from
+## getviewport()) is queried in device pixels and the world coordinate
+## window is used to map x,y onto pixel columns/rows.
+## Data sets with fewer points than this many times the number of pixel
+## columns are drawn as-is
+lodFactor = 4
+
+# returns (number of pixel columns, number of pixel rows, window) or None
+def pixelGrid(dev):
+    (vx1, vx2, vy1, vy2) = dev.pgqvp(3)
+    win                  = dev.pgqwin()
+    (nx, ny)             = (int(math.ceil(abs(vx2-vx1))), int(math.ceil(abs(vy2-vy1))))
+    if nx<1 or ny<1 or win[0]==win[1] or win[2]==win[3]:
+        return None
+    return (nx, ny, win)
+
+# map world coordinates to pixel index, everything outside the window
+# ends up in the pixel just outside of it: -1 or n
+def toPixel(v, n, lo, hi):
+    return numpy.clip(numpy.floor((v - lo)*(n/(hi - lo))), -1, n).astype(numpy.int64)
+
+# For lines keep, per pixel column, the first, last, lowest and highest point
+# such that the drawn envelope is identical to drawing all points.
+# Only applicable if x is sorted, otherwise the line would be different
+def decimateLines(x, y, grid):
+    (nx, ny, win) = grid
+    if len(x)<=lodFactor*nx or numpy.any(numpy.diff(x)<0):
+        return (x, y)
+    col    = toPixel(x, nx, win[0], win[1])
+    seg    = numpy.r_[0, numpy.cumsum(numpy.diff(col)!=0)]
+    starts = numpy.r_[0, numpy.flatnonzero(numpy.diff(seg))+1]
+    ends   = numpy.r_[starts[1:], len(x)] - 1
+    # within each column sort by y: first is min, last is max
+    order  = numpy.lexsort((y, seg))
+    keep   = numpy.unique(numpy.concatenate((starts, ends, order[starts], order[ends])))
+    return (x[keep], y[keep])
+
+# For points keep one point per pixel
+def decimatePoints(x, y, grid):
+    (nx, ny, win) = grid
+    if len(x)<=lodFactor*nx:
+        return (x, y)
+    pix  = toPixel(x, nx, win[0], win[1])*(ny+2) + toPixel(y, ny, win[2], win[3])
+    keep = numpy.sort(numpy.unique(pix, return_index=True)[1])
+    return (x[keep], y[keep])
+
+
 
 # Take two labels and join them - i.e. to go from separate plot/data set labels 
 # to full data set label
@@ -191,7 +267,7 @@ class minidataset(object):
         self.ylims  = yl
 
 class plt_dataset(object):
-    __slots__ = ('_xval', '_yval', '_xlims', '_ylims', 'isSorted', 'prevFlag', 'n', 'n_nan', '__xval', '__yval', '_m_flagged','_m_unflagged', '_m_nan')
+    __slots__ = ('_xval', '_yval', '_xlims', '_ylims', 'isSorted', 'prevFlag', 'n', 'n_nan', '__xval', '__yval', '_m_flagged','_m_unflagged', '_m_nan', '_views', '_display', '_limits')
     _xformMap = { list:                      lambda a, m: numpy.ma.MaskedArray(numpy.array(a), mask=m),
                   numpy.ndarray:             lambda a, m: numpy.ma.MaskedArray(a, mask=m),
                   numpy.ma.core.MaskedArray: lambda a, m: numpy.ma.MaskedArray(a, mask=numpy.logical_or(a.mask, False if m is None else m))}
@@ -204,6 +280,9 @@ class plt_dataset(object):
         self._m_unflagged = ~self._m_flagged
         self._m_nan       = ~numpy.isfinite(self._yval.data)
         self.isSorted     = False
+        self._views       = None
+        self._display     = None
+        self._limits      = None
 
     # sort by x-axis value. do that once
     def sort(self):
@@ -217,40 +296,251 @@ class plt_dataset(object):
         self._m_flagged   = self._m_flagged[idxes]
         self._m_unflagged = self._m_unflagged[idxes]
         self._m_nan       = self._m_nan[idxes]
+        self._views       = None
         self.isSorted = True
         return self
 
     def getxy(self, m):
         return (numpy.ma.array(self._xval.data, mask=m).compressed(), numpy.ma.array(self._yval.data, mask=m).compressed())
 
+    # Compute, in one go, the unflagged and flagged x,y arrays (NaN & friends
+    # always blocked) and their ranges. Only needs to be redone if the order
+    # of the points changes (see sort()).
+    # Returns (unflagged, flagged), each None or (x, y, xlims, ylims)
+    def views(self):
+        if self._views is None:
+            valid    = ~self._m_nan
+            flagged  = numpy.broadcast_to(self._m_flagged, valid.shape)
+            (xd, yd) = (self._xval.data, self._yval.data)
+            def view(sel):
+                if not numpy.any(sel):
+                    return None
+                (x, y) = (xd[sel], yd[sel])
+                return (x, y, (numpy.min(x), numpy.max(x)), (numpy.min(y), numpy.max(y)))
+            self.set_views( (view(valid & ~flagged), view(valid & flagged)) )
+        return self._views
+
+    # The x/y ranges of the unflagged and flagged points (NaN & friends
+    # always blocked), without keeping the selected points around.
+    # Returns (unflagged, flagged), each None or (xlims, ylims)
+    def limits(self):
+        if self._limits is None:
+            if self._views is not None:
+                self._limits = map(lambda v: None if v is None else (v[2], v[3]), self._views)
+            else:
+                valid    = ~self._m_nan
+                flagged  = numpy.broadcast_to(self._m_flagged, valid.shape)
+                (xd, yd) = (self._xval.data, self._yval.data)
+                def lims(sel):
+                    if not numpy.any(sel):
+                        return None
+                    (x, y) = (xd[sel], yd[sel])
+                    return ((numpy.min(x), numpy.max(x)), (numpy.min(y), numpy.max(y)))
+                self._limits = [lims(valid & ~flagged), lims(valid & flagged)]
+        return self._limits
+
+    # The x/y ranges of what prepare_for_display(flagSetting) would
+    # display, None if nothing. Cheap: the points aren't selected
+    def display_limits(self, flagSetting):
+        (lu, lf) = self.limits()
+        u  = lu if flagSetting in [FLAG.Unflagged, FLAG.Both] else None
+        f  = lf if flagSetting in [FLAG.Flagged, FLAG.Both]   else None
+        ls = filter(operator.truth, [u, f])
+        if not ls:
+            return None
+        return ((min(map(lambda l: l[0][0], ls)), max(map(lambda l: l[0][1], ls))),
+                (min(map(lambda l: l[1][0], ls)), max(map(lambda l: l[1][1], ls))))
+
+    # install the views and forget what was prepared from the old ones
+    def set_views(self, views):
+        self._views   = views
+        self._display = dict()
+
     def prepare_for_display(self, flagSetting):
-        # prepare variables for unflagged x+y, flagged x+y and x+y min+max
-        (xu, yu, xf, yf) = [None]*4
-        (xi, xa, yi, ya) = [list(), list(), list(), list()]
+        (vu, vf) = self.views()
+        if flagSetting in self._display:
+            return self._display[flagSetting]
         # Depending on what to show, get those datapoints
-        if flagSetting in [FLAG.Unflagged, FLAG.Both]:
-            # reset to creation mask [and always block NaN & friends]
-            newMask    = numpy.logical_or(self._m_flagged, self._m_nan)
-            if not numpy.all(newMask):
-                # there are non-flagged entries
-                (xu, yu) = self.getxy( newMask )
-                xi.append( min(xu) )
-                xa.append( max(xu) )
-                yi.append( min(yu) )
-                ya.append( max(yu) )
-        if flagSetting in [FLAG.Flagged, FLAG.Both]:
-            newMask   = numpy.logical_or(self._m_unflagged, self._m_nan)
-            if not numpy.all(newMask):
-                # there are non-flagged entries
-                (xf, yf) = self.getxy( newMask )
-                xi.append( min(xf) )
-                xa.append( max(xf) )
-                yi.append( min(yf) )
-                ya.append( max(yf) )
-
-        # if the list(s) of min/max don't have any entries there were no points to display at all
-        # so only need to test one of 'm
-        return None if not xi else minidataset(xu, yu, xf, yf, (min(xi), max(xa)), (min(yi), max(ya)))
+        u = vu if flagSetting in [FLAG.Unflagged, FLAG.Both] else None
+        f = vf if flagSetting in [FLAG.Flagged, FLAG.Both]   else None
+        # if neither has entries there were no points to display at all
+        vs = filter(operator.truth, [u, f])
+        rv = None if not vs else minidataset(u[0] if u else None, u[1] if u else None,
+                                             f[0] if f else None, f[1] if f else None,
+                                             (min(map(lambda v: v[2][0], vs)), max(map(lambda v: v[2][1], vs))),
+                                             (min(map(lambda v: v[3][0], vs)), max(map(lambda v: v[3][1], vs))))
+        self._display[flagSetting] = rv
+        return rv
+
+## Build plt_datasets from the rows of 2-D x, y and flag arrays. The
+## NaN and (un)flagged masks are computed once for all rows; the data
+## sets share them [and the x, y data] in stead of copying.
+def plt_datasets_from_rows(x, y, m_flagged, isSorted=False):
+    return mk_plt_datasets(zip(x, y, m_flagged, ~m_flagged, ~numpy.isfinite(y)), isSorted)
+
+## Same, but from flat x, y and flag arrays holding consecutive
+## data sets of 'counts' points each
+def plt_datasets_from_segments(x, y, m_flagged, counts, isSorted=False):
+    offs = numpy.cumsum(counts)[:-1]
+    return mk_plt_datasets(zip(*map(lambda a: numpy.split(a, offs), [x, y, m_flagged, ~m_flagged, ~numpy.isfinite(y)])), isSorted)
+
+def mk_plt_datasets(parts, isSorted):
+    def mk( (x, y, m_flagged, m_unflagged, m_nan) ):
+        ds              = object.__new__(plt_dataset)
+        ds._yval        = numpy.ma.MaskedArray(y, mask=m_flagged, copy=False)
+        ds._xval        = numpy.ma.MaskedArray(x, mask=m_flagged, copy=False)
+        ds._m_flagged   = m_flagged
+        ds._m_unflagged = m_unflagged
+        ds._m_nan       = m_nan
+        ds.isSorted     = isSorted
+        ds._views       = None
+        ds._display     = None
+        ds._limits      = None
+        return ds
+    return map(mk, parts)
+
+
+## A set of plots: 'Dict[plotlabel] => Dict[datasetlabel] => minidataset',
+## organized lazily. Only the labels are organized up front; the data sets
+## of a plot are prepared for display (by 'prepare') when that plot is
+## accessed, i.e. when its page is drawn. Up front only the x/y ranges of
+## what a data set would display are computed (by 'limits', returns None
+## or (xlims, ylims)). Data sets that have nothing to display are dropped
+## right away, plots without data sets are not created.
+class plotset(Dict):
+    def __init__(self, prepare, limits):
+        super(plotset, self).__init__()
+        self._prepare = prepare
+        self._limits  = limits
+        self._pending = dict()
+        self._changed()
+
+    # any change to the plots invalidates the label table
+    # and the values computed over it
+    def _changed(self):
+        self._dstable = None
+        self._dscache = dict()
+
+    def add(self, plotlabel, dslabel, dataset):
+        lims = self._limits(dataset)
+        if lims is None:
+            return
+        dict.setdefault(self, plotlabel, Dict())
+        self._pending.setdefault(plotlabel, list()).append( (dslabel, dataset, lims) )
+        self._changed()
+
+    # sequence of (type, xlims, ylims) for the data sets of a plot,
+    # without preparing the ones that weren't prepared yet
+    def ranges(self, plotlabel):
+        return map(lambda (l, ds): (l.TYPE, ds.xlims, ds.ylims), dict.__getitem__(self, plotlabel).iteritems()) + \
+               map(lambda (l, ds, lims): (l.TYPE,)+lims, self._pending.get(plotlabel, []))
+
+    # columnar table of all data set labels in all plots
+    def dstable(self):
+        if self._dstable is None:
+            self._dstable = label_v6.labeltable( set(itertools.chain.from_iterable(map(self.dslabels, self.keys()))) )
+        return self._dstable
+
+    # dict of data set label => fn(data set label) for all data set labels,
+    # with 'fn' evaluated once per distinct combination of values of the
+    # label attributes 'attrs' (None = all attributes). The result is
+    # cached under 'key' until the plots change
+    def dslookup(self, key, fn, attrs=None):
+        if key not in self._dscache:
+            tbl = self.dstable()
+            self._dscache[key] = dict(itertools.izip(tbl.labels, tbl.apply(fn, attrs)))
+        return self._dscache[key]
+
+    # dict of data set label => number of its distinct combination
+    # of values of the label attributes 'attrs'
+    def dsgroups(self, attrs=None):
+        tbl = self.dstable()
+        return dict(itertools.izip(tbl.labels, tbl.groups(attrs)[0]))
+
+    # the data set labels of a plot, without preparing the data sets
+    def dslabels(self, plotlabel):
+        return dict.__getitem__(self, plotlabel).keys() + map(operator.itemgetter(0), self._pending.get(plotlabel, []))
+
+    def __getitem__(self, plotlabel):
+        pref = dict.__getitem__(self, plotlabel)
+        for (dslabel, dataset, lims) in self._pending.pop(plotlabel, []):
+            ds = self._prepare(dataset)
+            if ds is not None:
+                pref[ dslabel ] = ds
+        return pref
+
+    def __setitem__(self, plotlabel, value):
+        self._pending.pop(plotlabel, None)
+        dict.__setitem__(self, plotlabel, value)
+        self._changed()
+
+    def __delitem__(self, plotlabel):
+        self._pending.pop(plotlabel, None)
+        dict.__delitem__(self, plotlabel)
+        self._changed()
+
+    def get(self, plotlabel, default=None):
+        return self[plotlabel] if plotlabel in self else default
+
+    def iteritems(self):
+        return ((k, self[k]) for k in self.keys())
+
+    def itervalues(self):
+        return (self[k] for k in self.keys())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+
+# compute x/y range per type from a sequence of (type, xlims, ylims)
+def minmax_per_type(ranges):
+    acc = collections.defaultdict(lambda: ([], [], [], []))
+    for (tp, xl, yl) in ranges:
+        tref = acc[tp]
+        tref[0].append( xl[0] )
+        tref[1].append( xl[1] )
+        tref[2].append( yl[0] )
+        tref[3].append( yl[1] )
+    rv = collections.defaultdict(Dict)
+    for (tp, mdata) in acc.iteritems():
+        rv[tp].xlim = (min(mdata[0]), max(mdata[1]))
+        rv[tp].ylim = (min(mdata[2]), max(mdata[3]))
+    return rv
+
+## Per plot x/y ranges per type, computed on demand:
+##   meta[ <plot> ][ <type> ].xlim, .ylim
+class plotmeta(dict):
+    def __init__(self, plotar):
+        super(plotmeta, self).__init__()
+        self.plotar = plotar
+
+    def __missing__(self, plotlabel):
+        if hasattr(self.plotar, 'ranges'):
+            return self.setdefault(plotlabel, minmax_per_type(self.plotar.ranges(plotlabel)))
+        return self.setdefault(plotlabel, minmax_per_type(map(lambda (l, ds): (l.TYPE, ds.xlims, ds.ylims), self.plotar[plotlabel].iteritems())))
+
+## Global x/y ranges per type, across all plots, computed from the per plot
+## ranges the first time they're asked for:
+##   limits[ <type> ].xlim, .ylim
+class plotlimits(dict):
+    def __init__(self, plotar):
+        super(plotlimits, self).__init__()
+        self.plotar = plotar
+        self.done   = False
+
+    def __missing__(self, tp):
+        if not self.done:
+            self.done = True
+            meta      = self.plotar.meta
+            self.update( minmax_per_type(((t, m.xlim, m.ylim) for k in self.plotar.keys() for (t, m) in meta[k].iteritems())) )
+            if not self:
+                raise RuntimeError, "WARNING: no data to display in any of the plots"
+            if tp in self:
+                return self[tp]
+        return self.setdefault(tp, Dict())
 
 
 Drawers = enumerations.Enum("Lines", "Points", "Both")
@@ -262,6 +552,7 @@ Drawers = enumerations.Enum("Lines", "Points", "Both")
 ####
 ##########################################################
 noFilter = lambda x: True
+noFilter.attributes = []
 
 
 class Plotter(object):
@@ -474,8 +765,10 @@ class Plotter(object):
             self.filter_fun[idx]   = parsers.parse_filter_expr( args[0] )
             self.filter_fun_s[idx] = CP(args[0])
 
+    # returns None or the (non-empty) array of indices of marked points
     def markedPointsForYAxis(self, idx, x, y):
-        return self.marker[idx](x, y) if self.marker[idx] else []
+        rv = self.marker[idx](x, y) if self.marker[idx] else None
+        return rv if (rv is not None and len(rv)) else None
 
     # Create a page label Dict with properties
     #   .left   .center and .right for page header display purposes
@@ -502,12 +795,18 @@ class Plotter(object):
         return rv
 
     def drawPoints(self, dev, x, y, tp):
+        grid = pixelGrid(dev)
+        if grid is not None:
+            (x, y) = decimatePoints(x, y, grid)
         olw = dev.pgqlw()
         dev.pgslw(self.pointSize)
         dev.pgpt(x, y, tp)
         dev.pgslw(olw)
 
     def drawLines(self, dev, x, y):
+        grid = pixelGrid(dev)
+        if grid is not None:
+            (x, y) = decimateLines(x, y, grid)
         olw = dev.pgqlw()
         dev.pgslw(self.lineWidth)
         dev.pgline(x, y)
@@ -527,6 +826,38 @@ class Plotter(object):
     def colkey(self, dslab, **opts):
         return self.ck_fun(dslab, self.ck_dict, **opts)
 
+    # colour index for data set label 'dslab' in plot set 'plotar'.
+    # The colour key only depends on the attributes in plotar.dslabel
+    # that the colour key function uses so the colour is computed once
+    # per distinct combination of those. The colours are still allocated
+    # in the order in which the data sets are drawn.
+    def colkeyOf(self, plotar, dslab, **opts):
+        if not hasattr(plotar, 'dsgroups'):
+            return self.colkey(label(dslab, plotar.dslabel), **opts)
+        attrs = map(lambda a: a.value, plotar.dslabel)
+        used  = getattr(self.ck_fun, 'attributes', None)
+        if used is not None:
+            attrs = filter(lambda a: a in used, attrs)
+        key   = tuple(attrs)
+        if key not in self.ck_groups:
+            self.ck_groups[key] = plotar.dsgroups(attrs)
+        grp   = (key, self.ck_groups[key][dslab])
+        if grp not in self.ck_cache:
+            self.ck_cache[grp] = self.colkey(label(dslab, plotar.dslabel), **opts)
+        return self.ck_cache[grp]
+
+    # the data sets of type 'ytype' in plot 'pref' of plot set 'plotar'
+    # that pass the filter of subplot 'idx'. Where possible the filter is
+    # evaluated once per plot set over its table of data set labels in stead
+    # of once per data set on each redraw
+    def datasetsFor(self, plotar, pref, idx, ytype):
+        fn    = self.filter_fun[idx]
+        if not hasattr(plotar, 'dslookup'):
+            return filter(lambda kv: kv[0].TYPE == ytype and fn(kv[0]), pref.iteritems())
+        attrs = getattr(fn, 'attributes', None)
+        sel   = plotar.dslookup((fn, ytype), lambda l: l.TYPE == ytype and fn(l), None if attrs is None else attrs+['TYPE'])
+        return filter(lambda kv: sel[kv[0]], pref.iteritems())
+
     def coldict(self):
         return self.ck_dict
 
@@ -548,7 +879,9 @@ class Plotter(object):
     #       the mapping between plots?
     def colkey_reset(self, *args):
         # if 'auto' in args and ... then self.ck_dict = dict()
-        self.ck_dict = dict()
+        self.ck_dict   = dict()
+        self.ck_cache  = dict()
+        self.ck_groups = dict()
 
     # the number of pages of plots this would produce
     def num_pages(self, plotar):
@@ -641,7 +974,7 @@ class Quant2TimePlotter(Plotter):
                 for (subplot, ytype) in enumerate(self.yAxis):
                     # filter the data sets with current y-axis type
                     # Keep the indices because we need them twice
-                    datasets = filter(lambda kv: kv[0].TYPE == ytype and self.filter_fun[subplot](kv[0]), pref.iteritems())
+                    datasets = self.datasetsFor(plotar, pref, subplot, ytype)
 
                     # the type may have been removed due to an expression/selection
                     if not datasets:
@@ -679,7 +1012,7 @@ class Quant2TimePlotter(Plotter):
                         device.pgslw(8)
                     for (lab, data) in datasets:
                         # get the colour key for this data set
-                        device.pgsci( self.colkey(label(lab, plotar.dslabel), **opts) )
+                        device.pgsci( self.colkeyOf(plotar, lab, **opts) )
                         # we know there's stuff to display so let's do that then
                         # Any marked data points to display?
                         (mu, mf) = (None, None)
@@ -694,9 +1027,9 @@ class Quant2TimePlotter(Plotter):
                         # draw markers if necessary
                         lw = device.pgqlw()
                         device.pgslw(self.markerSize)
-                        if mu:
+                        if mu is not None:
                             device.pgpt( data.xval[mu] - day0hr, data.yval[mu], 7)
-                        if mf:
+                        if mf is not None:
                             device.pgpt( data.xval_f[mf] - day0hr, data.yval_f[mf], 27)
                         device.pgslw(lw)
                         # Any extra drawing commands?
@@ -789,7 +1122,7 @@ class GenXvsYPlotter(Plotter):
 
                 # filter the data sets with type yType
                 # Keep the indices because we need them twice
-                datasets = filter(lambda kv: kv[0].TYPE == self.yAxis[0] and self.filter_fun[0](kv[0]), pref.iteritems())
+                datasets = self.datasetsFor(plotar, pref, 0, self.yAxis[0])
 
                 # Set up the plotcoord for this plot, including
                 # world coordinate limits
@@ -817,7 +1150,7 @@ class GenXvsYPlotter(Plotter):
                 # actually in the data set labels
                 for (lab, data) in datasets:
                     # get the colour key for this data set
-                    device.pgsci( self.colkey(label(lab, plotar.dslabel), **opts) )
+                    device.pgsci( self.colkeyOf(plotar, lab, **opts) )
                     # we know there's stuff to display so let's do that then
                     # Any marked data points to display?
                     (mu, mf) = (None, None)
@@ -833,9 +1166,9 @@ class GenXvsYPlotter(Plotter):
                     # draw markers if necessary
                     lw = device.pgqlw()
                     device.pgslw(self.markerSize)
-                    if mu:
+                    if mu is not None:
                         device.pgpt( data.xval[mu], data.yval[mu], 7)
-                    if mf:
+                    if mf is not None:
                         device.pgpt( data.xval_f[mf], data.yval_f[mf], 27)
                     device.pgslw(lw)
                     self.doExtraCallbacks(device, data)
@@ -889,11 +1222,9 @@ class Quant2ChanPlotter(Plotter):
         # Now we know how many plots/page so we can compute how many plots to do
         last     = min(first + n, len(plotar))
 
-        # We need to have the real frequencies
-        try:
-            mysm = ms2util.makeSpectralMap( plotar.msname )
-        except RuntimeError:
-            mysm = None
+        # We need to have the real frequencies; these were
+        # captured in the plots when the data was read
+        freqs = getattr(plotar, 'frequencies', None)
 
         pagelabel = self.mk_pagelabel( plotar )
 
@@ -941,7 +1272,7 @@ class Quant2ChanPlotter(Plotter):
                 for (subplot, ytype) in enumerate(self.yAxis):
                     # filter the data sets with current y-axis type
                     # Keep the indices because we need them twice
-                    datasets = filter(lambda kv: kv[0].TYPE == ytype and self.filter_fun[subplot](kv[0]), pref.iteritems())
+                    datasets = self.datasetsFor(plotar, pref, subplot, ytype)
 
                     # the specific type may have been removed?
                     if not datasets:
@@ -991,7 +1322,7 @@ class Quant2ChanPlotter(Plotter):
                     # actually in the data set labels
                     for (lab, data) in datasets:
                         # get the colour key for this data set
-                        device.pgsci( self.colkey(label(lab, plotar.dslabel), **opts) )
+                        device.pgsci( self.colkeyOf(plotar, lab, **opts) )
                         # we know there's stuff to display so let's do that then
                         # Any marked data points to display?
                         (mu, mf) = (None, None)
@@ -1012,10 +1343,10 @@ class Quant2ChanPlotter(Plotter):
                         # draw markers if necessary
                         lw = device.pgqlw()
                         device.pgslw(self.markerSize)
-                        if mu:
-                            # if mu evaluates to True then xu is also not-None
+                        if mu is not None:
+                            # if mu is set then xu is also not-None
                             device.pgpt( xu[mu], data.yval[mu], 7)
-                        if mf:
+                        if mf is not None:
                             # id. for the flagged stuff
                             device.pgpt( xf[mf], data.yval_f[mf], 27)
                         device.pgslw(lw)
@@ -1035,10 +1366,10 @@ class Quant2ChanPlotter(Plotter):
                         # because the user has overplotted >1 subband in one plot
                         device.pgsch( 0.5 )
                         if plotlabel.FQ is not None and plotlabel.SB is not None:
-                            if mysm is None:
+                            if freqs is None or (plotlabel.FQ, plotlabel.SB) not in freqs:
                                 frqedge = "no freq info"
                             else:
-                                frqedge = "{0:f}MHz".format( mysm.frequencyOfFREQ_SB(plotlabel.FQ, plotlabel.SB)/1.0e6 )
+                                frqedge = "{0:f}MHz".format( freqs[(plotlabel.FQ, plotlabel.SB)][0]/1.0e6 )
                         else:
                             frqedge = "multi SB"
                         device.pgmtxt( 'B', -1, 0.01, 0.0, frqedge )
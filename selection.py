@@ -39,7 +39,7 @@
 # Revision 1.2  2013-01-29 12:23:45  jive_cc
 # HV: * time to commit - added some more basic stuff
 #
-import jenums, hvutil, copy
+import jenums, hvutil, copy, msindex
 
 class selection:
     def __init__(self):
@@ -135,6 +135,28 @@ class selection:
                              [self.baselinesTaql, self.sourcesTaql, self.timeRangeTaql, self.ddSelectionTaql]), \
                       "")
 
+    # Evaluate the selection on the meta data index of the MS (see msindex.py)
+    # in stead of building a query. Returns the sorted list of selected row
+    # numbers or None if the selection can only be expressed in TaQL
+    def selectionRows(self, index, mapping):
+        if self.taqlString:
+            return None
+        bls   = None
+        if self.baselinesTaql:
+            bls = map(lambda (x, y): msindex.baselineCode(x, y), map(mapping.baselineMap.baselineIndex, self.baselines))
+        srcs  = map(mapping.fieldMap.unfield, self.sources) if self.sourcesTaql else None
+        ddids = None
+        if self.ddSelectionTaql:
+            ddids = map(lambda (f, s, p, l): mapping.spectralMap.datadescriptionIdOfFREQ_SB_POL(f, s, p), self.ddSelection)
+        # a scan selection sets the time range TaQL to select the scans
+        trs   = None
+        scans = None
+        if self.scanSel:
+            scans = map(lambda o: (o.start, o.end, o.field_id, o.array_id, o.scan_number), self.scanSel)
+        elif self.timeRangeTaql:
+            trs   = self.timeRange
+        return index.rows(baselines=bls, fields=srcs, timeranges=trs, ddids=ddids, scans=scans)
+
     def mkCPPNewplot(self):
         # return a list of True/False values for all plot axes in the order the C++
         # expects them